@@ -1,9 +1,34 @@
 from django.contrib import admin
-from .models import User, Pronunciation, Poem, Algorithm, PoemScansion
+from .models import User, Pronunciation, WordStats, LexiconState, Poem, WordOccurrence, Algorithm, PoemScansion
+from .scan import pronunciations_changed
+
+# keep WordStats and the caches in step with patterns edited in the admin
+# (loaddata and other direct writes need `manage.py rebuild_word_stats`)
+class PronunciationAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        words = {obj.word}
+        if change:
+            # the word itself may have been edited
+            words.update(Pronunciation.objects.filter(pk=obj.pk).values_list("word", flat=True))
+        super().save_model(request, obj, form, change)
+        pronunciations_changed(words)
+
+    def delete_model(self, request, obj):
+        word = obj.word
+        super().delete_model(request, obj)
+        pronunciations_changed([word])
+
+    def delete_queryset(self, request, queryset):
+        words = set(queryset.values_list("word", flat=True))
+        super().delete_queryset(request, queryset)
+        pronunciations_changed(words)
 
 # Register your models here.
 admin.site.register(User)
-admin.site.register(Pronunciation)
+admin.site.register(Pronunciation, PronunciationAdmin)
+admin.site.register(WordStats)
+admin.site.register(LexiconState)
 admin.site.register(Poem)
+admin.site.register(WordOccurrence)
 admin.site.register(Algorithm)
 admin.site.register(PoemScansion)
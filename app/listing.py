@@ -0,0 +1,144 @@
+"""MODULE LISTING
+==================
+This module lists poems for choose_poem a page at a time.
+
+Each page fetches only the id, title and poet of its poems, ordered by
+poet and id on the (human_scanned, poet) index, and is kept in memory
+until a poem is added, deleted or has its title, poet or human_scanned
+flag changed (see `signals.py`). Pages are also dropped every
+SCAN_POEM_LISTING_TTL seconds to pick up changes made by other
+processes.
+
+Classes
+-------
+
+PoemPage : One page of the listing of human- or computer-scanned poems.
+PoemListing : Cached pages of the listings.
+"""
+
+
+import threading
+import time
+from django.conf import settings
+from django.core.paginator import Paginator
+from .models import Poem
+
+# fields shown in the listing; saving only other fields keeps the cache
+LISTED_FIELDS = {"title", "poet", "human_scanned"}
+
+
+class PoemPage:
+    """One page of poems, detached from the queryset it was read from.
+
+    Attributes
+    ----------
+    poems : list
+        Poems with only id, title and poet loaded
+    number, num_pages, count : int
+        page number, number of pages and number of poems in the listing
+    """
+
+    def __init__(self, poems, number, num_pages, count):
+        self.poems = poems
+        self.number = number
+        self.num_pages = num_pages
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.poems)
+
+    def __len__(self):
+        return len(self.poems)
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_next(self):
+        return self.number < self.num_pages
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_page_number(self):
+        return self.number + 1
+
+
+class PoemListing:
+    """Pages of human- and computer-scanned poems, cached between changes.
+
+    Parameters
+    ----------
+    per_page : int
+        poems per page
+
+    ttl : float
+        seconds after which cached pages are read again
+    """
+
+    def __init__(self, per_page, ttl):
+        self.per_page = per_page
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.pages = {}
+        # human_scanned -> number of pages, so pages past the last one are
+        # cached as the last page rather than under every number asked for
+        self.num_pages = {}
+        self.loaded_at = 0.0
+        # incremented by invalidate, so pages read before it are not kept
+        self.version = 0
+
+    def invalidate(self):
+        """Read every page from the database the next time it is shown."""
+        with self.lock:
+            self.pages = {}
+            self.num_pages = {}
+            self.version += 1
+
+    def page(self, human_scanned, number):
+        """Return page number of the listing, or the last one if it is past it.
+
+        Parameters
+        ----------
+        human_scanned : bool
+            list human-scanned poems rather than computer-scanned ones
+
+        number : int or str
+            page number, as given in the query string; invalid numbers
+            give the first page
+
+        Returns
+        -------
+        page : PoemPage
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            number = 1
+        with self.lock:
+            if time.monotonic() - self.loaded_at > self.ttl:
+                self.pages = {}
+                self.num_pages = {}
+                self.loaded_at = time.monotonic()
+            # as Paginator.get_page, numbers out of range give the last page
+            num_pages = self.num_pages.get(human_scanned)
+            if num_pages is not None and not 1 <= number <= num_pages:
+                number = num_pages
+            page = self.pages.get((human_scanned, number))
+            version = self.version
+        if page is not None:
+            return page
+        poems = (Poem.objects.filter(human_scanned=human_scanned)
+                 .only("id", "title", "poet").order_by("poet", "id"))
+        paginator = Paginator(poems, self.per_page)
+        found = paginator.get_page(number)
+        page = PoemPage(list(found.object_list), found.number,
+                        paginator.num_pages, paginator.count)
+        with self.lock:
+            if self.version == version:
+                self.pages[(human_scanned, page.number)] = page
+                self.num_pages[human_scanned] = page.num_pages
+        return page
+
+
+poem_listing = PoemListing(getattr(settings, "SCAN_POEMS_PER_PAGE", 100),
+                           getattr(settings, "SCAN_POEM_LISTING_TTL", 300))
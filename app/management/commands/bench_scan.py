@@ -0,0 +1,237 @@
+import json
+import random
+import time
+from contextlib import contextmanager
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.utils import load_backend
+from django.test.utils import override_settings
+
+from app import scan
+from app.models import Pronunciation
+
+# syllables synthetic words are built from
+ONSETS = ["", "b", "bl", "br", "c", "ch", "d", "dr", "f", "fl", "g", "gr", "h", "l", "m",
+          "n", "p", "pr", "r", "s", "sh", "sl", "st", "t", "th", "tr", "v", "w", "wh"]
+NUCLEI = ["a", "e", "i", "o", "u", "ai", "ea", "ee", "oo", "ou", "y"]
+CODAS = ["", "", "", "d", "ght", "l", "m", "n", "nd", "r", "rt", "s", "st", "t", "th"]
+
+STAGES = ["get_stats", "poem_stats", "syllables", "original_scan", "house_robber_scan",
+          "prose_scan", "record"]
+
+
+@contextmanager
+def isolated_database(alias=None):
+    """Point the default connection of this thread at another database.
+
+    The database is a new in-memory SQLite one, or the one configured
+    for alias, and is migrated first. The default connection is put back
+    afterwards, and the compiled lexicon file is ignored in between.
+    """
+    if alias is None:
+        settings_dict = {**connections.databases[DEFAULT_DB_ALIAS], "OPTIONS": {},
+                         "ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+    else:
+        settings_dict = dict(connections.databases[alias])
+    connection = load_backend(settings_dict["ENGINE"]).DatabaseWrapper(settings_dict,
+                                                                       DEFAULT_DB_ALIAS)
+    default = connections[DEFAULT_DB_ALIAS]
+    connections[DEFAULT_DB_ALIAS] = connection
+    try:
+        with override_settings(SCAN_LEXICON_FILE=None):
+            call_command("migrate", database=DEFAULT_DB_ALIAS, interactive=False, verbosity=0)
+            yield
+    finally:
+        connection.close()
+        connections[DEFAULT_DB_ALIAS] = default
+
+
+class Command(BaseCommand):
+    help = ("Time the scanning hot paths on a reproducible synthetic lexicon and corpus "
+            "and compare them to a baseline. They are built in a new in-memory SQLite "
+            "database (or the one given with --database, in a transaction that is "
+            "rolled back), never in the configured one.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10,100,1000",
+                            help="comma-separated corpus sizes, in poems (default: 10,100,1000)")
+        parser.add_argument("--vocabulary", type=int, default=5000,
+                            help="number of words in the synthetic lexicon")
+        parser.add_argument("--seed", type=int, default=0,
+                            help="random seed for the lexicon and corpus")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="times to run each stage; the fastest run is kept")
+        parser.add_argument("--record-limit", type=int, default=50,
+                            help="most poems recorded per corpus size")
+        parser.add_argument("--output", help="write the JSON results to this file "
+                                             "instead of standard output")
+        parser.add_argument("--baseline", help="JSON results to compare against")
+        parser.add_argument("--save-baseline", help="also write the results to this file")
+        parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="fraction by which a stage may be slower than the baseline "
+                                 "(default: 0.25)")
+        parser.add_argument("--min-seconds", type=float, default=0.001,
+                            help="stages faster than this are never counted as regressions")
+        parser.add_argument("--database",
+                            help="alias in DATABASES of a scratch database to run on, to "
+                                 "time another engine; it is migrated first "
+                                 "(default: a new in-memory SQLite database)")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be a comma-separated list of integers.")
+        alias = options["database"]
+        if alias == DEFAULT_DB_ALIAS:
+            raise CommandError("--database must be a scratch database, not the default one.")
+        if alias is not None and alias not in connections.databases:
+            raise CommandError(f"No database {alias!r} in DATABASES.")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"], encoding="utf-8") as f:
+                baseline = json.load(f)
+        self.rng = random.Random(options["seed"])
+        self.repeat = max(options["repeat"], 1)
+        results = {"seed": options["seed"], "vocabulary": options["vocabulary"],
+                   "repeat": self.repeat, "sizes": {}}
+        scan.clear_caches()
+        try:
+            with isolated_database(alias), transaction.atomic():
+                words = self.build_lexicon(options["vocabulary"])
+                for size in sizes:
+                    corpus = self.build_corpus(words, size)
+                    results["sizes"][str(size)] = self.bench(corpus, options["record_limit"])
+                # leave a --database as it was
+                transaction.set_rollback(True)
+        finally:
+            # and drop everything cached about the synthetic lexicon
+            scan.clear_caches()
+            scan.count_syllables.cache_clear()
+
+        text = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        else:
+            self.stdout.write(text)
+        if options["save_baseline"]:
+            with open(options["save_baseline"], "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        if baseline is not None:
+            regressions = self.compare(results, baseline, options["tolerance"],
+                                       options["min_seconds"])
+            if regressions:
+                raise CommandError("Slower than the baseline:\n" + "\n".join(regressions))
+            # report on stderr so stdout stays valid JSON
+            self.stderr.write("No regressions against the baseline.")
+
+    def make_word(self, syllables):
+        return "".join(self.rng.choice(ONSETS) + self.rng.choice(NUCLEI) + self.rng.choice(CODAS)
+                       for _ in range(syllables))
+
+    def build_lexicon(self, size):
+        """Create size synthetic words with stress patterns, most common first."""
+        words = []
+        seen = set()
+        rows = []
+        while len(words) < size:
+            syllables = self.rng.choices([1, 2, 3, 4], weights=[50, 30, 15, 5])[0]
+            word = self.make_word(syllables)
+            if word in seen or len(word) > 50:
+                continue
+            seen.add(word)
+            words.append(word)
+            # one to three stress patterns of the word's length
+            for _ in range(self.rng.randint(1, 3)):
+                stresses = "".join(self.rng.choice("u/") for _ in range(syllables))
+                rows.append(Pronunciation(word=word, stresses=stresses,
+                                          popularity=self.rng.randint(1, 100)))
+        Pronunciation.objects.bulk_create(rows, batch_size=scan.LOOKUP_BATCH_SIZE,
+                                          ignore_conflicts=True)
+        call_command("rebuild_word_stats", stdout=StringIO())
+        return words
+
+    def build_corpus(self, words, size):
+        """Create size poems of Zipf-distributed words, with some unknown ones."""
+        # word of rank r is drawn with probability proportional to 1 / r
+        weights = [1 / rank for rank in range(1, len(words) + 1)]
+        poems = []
+        for _ in range(size):
+            lines = []
+            for _ in range(self.rng.randint(4, 20)):
+                count = self.rng.randint(5, 10)
+                line = self.rng.choices(words, weights=weights, k=count)
+                # about one word in twenty is missing from the lexicon
+                line = [self.make_word(self.rng.randint(1, 3)) + "ing" if self.rng.random() < 0.05
+                        else word for word in line]
+                line[0] = line[0].capitalize()
+                lines.append(" ".join(line) + self.rng.choice([",", ";", ".", ""]))
+            poems.append("\n".join(lines))
+        return poems
+
+    def time_stage(self, run):
+        """Return the fastest of self.repeat runs of run(), from cold caches."""
+        best = None
+        for _ in range(self.repeat):
+            scan.clear_caches()
+            scan.count_syllables.cache_clear()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def bench(self, corpus, record_limit):
+        tokens = [token for poem in corpus for tokens in scan.tokenize(poem) for token in tokens]
+        distinct = sorted({token.norm for token in tokens})
+        stress_lists = [scan.poem_stats(poem) for poem in corpus]
+        unknown = [word for word, (values, popularity) in scan.lexicon_stats(distinct).items()
+                   if popularity == 0]
+        stages = {
+            "get_stats": (lambda: [scan.get_stats(word) for word in distinct], len(distinct)),
+            "poem_stats": (lambda: [scan.poem_stats(poem) for poem in corpus], len(corpus)),
+            "syllables": (lambda: scan.syllables_many(unknown), len(unknown)),
+        }
+        for name in ["original_scan", "house_robber_scan", "prose_scan"]:
+            algorithm = scan.SCANS[name]
+            stages[name] = (lambda algorithm=algorithm: [algorithm(poem, stress_list=stress_list)
+                                                         for poem, stress_list
+                                                         in zip(corpus, stress_lists)],
+                            len(corpus))
+        recorded = list(zip(corpus, (scan.house_robber_scan(poem, stress_list=stress_list)
+                                     for poem, stress_list in zip(corpus, stress_lists))))[:record_limit]
+        def record_all():
+            # each run's writes are undone so every run starts from the same data
+            with transaction.atomic():
+                for poem, scansion in recorded:
+                    scan.record(poem, scansion)
+                transaction.set_rollback(True)
+        stages["record"] = (record_all, len(recorded))
+
+        results = {"poems": len(corpus), "words": len(tokens)}
+        for name in STAGES:
+            run, operations = stages[name]
+            seconds = self.time_stage(run)
+            results[name] = {"seconds": round(seconds, 6), "operations": operations,
+                             "us_per_operation": round(seconds / operations * 1e6, 3)
+                             if operations else 0.0}
+        return results
+
+    def compare(self, results, baseline, tolerance, min_seconds):
+        """Return a line for every stage slower than in baseline."""
+        regressions = []
+        for size, stages in results["sizes"].items():
+            base_stages = baseline.get("sizes", {}).get(size, {})
+            for name in STAGES:
+                if name not in base_stages:
+                    continue
+                seconds = stages[name]["seconds"]
+                base = base_stages[name]["seconds"]
+                if seconds >= min_seconds and seconds > base * (1 + tolerance):
+                    regressions.append(f"  {name} on {size} poems: {seconds:.6f}s "
+                                       f"(baseline {base:.6f}s)")
+        return regressions
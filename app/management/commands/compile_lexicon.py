@@ -0,0 +1,59 @@
+import os
+import struct
+import time
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Pronunciation
+from app.scan import (LEXICON_HEADER, LEXICON_KEY, LEXICON_MAGIC, LEXICON_OFFSET,
+                      LEXICON_RECORD, pattern_stats)
+
+
+class Command(BaseCommand):
+    help = "Compile Pronunciation into a binary lexicon file for memory-mapped lookups."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="file to write; default: SCAN_LEXICON_FILE")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="number of Pronunciation rows fetched at a time")
+
+    def handle(self, *args, **options):
+        path = options["output"] or getattr(settings, "SCAN_LEXICON_FILE", None)
+        if not path:
+            raise CommandError("Pass --output or set SCAN_LEXICON_FILE.")
+        # words changed after this moment are looked up in the database instead
+        compiled_at = time.time()
+        rows = (Pronunciation.objects
+                .order_by("word", "pk")
+                .values_list("word", "stresses", "popularity")
+                .iterator(chunk_size=options["chunk_size"]))
+        records = []
+        for word, group in groupby(rows, key=lambda row: row[0]):
+            try:
+                values, popularity = pattern_stats([row[1:] for row in group])
+            # a lone pattern with popularity 0 has no ratio; skip it
+            except ZeroDivisionError:
+                continue
+            key = word.encode("utf-8")
+            records.append((key, LEXICON_RECORD.pack(len(values), popularity)
+                                 + struct.pack(f"<{len(values)}d", *values)))
+        # the reader binary-searches on the words' UTF-8 bytes
+        records.sort(key=lambda record: record[0])
+
+        offset = LEXICON_HEADER.size + LEXICON_OFFSET.size * len(records)
+        offsets = []
+        for key, data in records:
+            offsets.append(LEXICON_OFFSET.pack(offset))
+            offset += LEXICON_KEY.size + len(key) + len(data)
+        # write next to the destination and swap it in, so readers never
+        # map a half-written file
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(LEXICON_HEADER.pack(LEXICON_MAGIC, len(records), compiled_at))
+            f.write(b"".join(offsets))
+            for key, data in records:
+                f.write(LEXICON_KEY.pack(len(key)) + key + data)
+        os.replace(tmp, path)
+        self.stdout.write(f"Compiled {len(records)} words into {path} ({offset} bytes).")
@@ -0,0 +1,181 @@
+import json
+import re
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.models import Pronunciation
+from app.scan import LOOKUP_BATCH_SIZE, add_popularities, normalize
+
+# CMUdict entries look like "ABANDON(1)  AH0 B AE1 N D AH0 N"
+cmudict_variant = re.compile(r"\(\d+\)$")
+cmudict_stress = re.compile(r"[012]")
+
+
+def iter_json_array(f, read_size=1 << 16):
+    """Yield the elements of the JSON array in file f one at a time.
+
+    Only as much of the file as the current element needs is kept in
+    memory, so a dictionary-sized fixture is never parsed all at once.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # skip whitespace (and, between elements, commas)
+        while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise CommandError("Unexpected end of JSON fixture.")
+            buffer = f.read(read_size)
+            pos = 0
+            eof = not buffer
+            continue
+        if not started:
+            if buffer[pos] != "[":
+                raise CommandError("JSON fixture must be an array of objects.")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            end = None
+        # an element that runs to the end of the buffer may be cut short
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise CommandError(f"Invalid JSON in fixture near: {buffer[pos:pos + 40]!r}")
+            more = f.read(read_size)
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+        yield element
+        pos = end
+
+
+class Command(BaseCommand):
+    help = ("Stream a lexicon into Pronunciation in chunks: a JSON fixture such as "
+            "data.json, a plain 'word stresses [popularity]' list or a CMUdict file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="file to import")
+        parser.add_argument("--format", choices=["fixture", "plain", "cmudict"],
+                            help="file format; default: fixture for .json files, otherwise plain")
+        parser.add_argument("--merge", action="store_true",
+                            help="add popularities to patterns that already exist "
+                                 "(by default existing patterns are left alone)")
+        parser.add_argument("--chunk-size", type=int, default=5000,
+                            help="number of entries written per transaction")
+        parser.add_argument("--secondary-stress", choices=["/", "u"], default="/",
+                            help="how to mark CMUdict secondary stress (2); default: /")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"] or ("fixture" if path.endswith(".json") else "plain")
+        self.secondary = options["secondary_stress"]
+        chunk_size = options["chunk_size"]
+        start = time.perf_counter()
+        imported = 0
+        # patterns created by earlier chunks, which later duplicates add to
+        self.created = set()
+        # model -> number of other objects in a fixture, left to loaddata
+        self.skipped = Counter()
+        with open(path, encoding="utf-8") as f:
+            entries = getattr(self, f"read_{file_format}")(f)
+            chunk = Counter()
+            for word, stresses, popularity in entries:
+                chunk[(word, stresses)] += popularity
+                imported += 1
+                if len(chunk) >= chunk_size:
+                    self.write_chunk(chunk, options["merge"], imported, start)
+                    chunk = Counter()
+            self.write_chunk(chunk, options["merge"], imported, start)
+        self.stdout.write(f"Imported {imported} entries from {path}.")
+        if self.skipped:
+            models = ", ".join(f"{model}: {count}"
+                               for model, count in sorted(self.skipped.items()))
+            self.stdout.write(f"Skipped {sum(self.skipped.values())} objects that are "
+                              f"not pronunciations ({models}); load them with loaddata.")
+
+    def write_chunk(self, chunk, merge, imported, start):
+        """Write one chunk of patterns in a single transaction and report progress."""
+        if not chunk:
+            return
+        if merge:
+            add_popularities(chunk)
+        else:
+            with transaction.atomic():
+                self.create_patterns(chunk)
+        elapsed = time.perf_counter() - start
+        rate = imported / elapsed if elapsed else 0.0
+        self.stdout.write(f"{imported} entries read ({rate:.0f}/second)")
+
+    def create_patterns(self, chunk):
+        """Create the patterns of chunk that were not in the database before the import.
+
+        Patterns an earlier chunk created get the chunk's popularity added,
+        the same as duplicates within one chunk.
+        """
+        again = {key: count for key, count in chunk.items() if key in self.created}
+        new = {key: count for key, count in chunk.items() if key not in self.created}
+        words = list({word for word, stresses in new})
+        for i in range(0, len(words), LOOKUP_BATCH_SIZE):
+            for key in (Pronunciation.objects.filter(word__in=words[i:i + LOOKUP_BATCH_SIZE])
+                        .values_list("word", "stresses")):
+                new.pop(key, None)
+        add_popularities(new, create_only=True)
+        add_popularities(again)
+        self.created.update(new)
+
+    def read_fixture(self, f):
+        """Yield (word, stresses, popularity) from a Django JSON fixture.
+
+        Objects of other models are counted in self.skipped.
+        """
+        for obj in iter_json_array(f):
+            if not isinstance(obj, dict) or obj.get("model") != "app.pronunciation":
+                self.skipped[str(obj.get("model")) if isinstance(obj, dict) else "?"] += 1
+                continue
+            fields = obj.get("fields", {})
+            word = normalize(fields.get("word", ""))
+            if word:
+                yield (word, fields.get("stresses", ""), fields.get("popularity", 0))
+
+    def read_plain(self, f):
+        """Yield (word, stresses, popularity) from 'word stresses [popularity]' lines."""
+        for number, line in enumerate(f, 1):
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            if len(parts) not in (2, 3) or set(parts[1]) - {"/", "u"}:
+                raise CommandError(f"Line {number}: expected 'word stresses [popularity]'.")
+            try:
+                popularity = int(parts[2]) if len(parts) == 3 else 1
+            except ValueError:
+                raise CommandError(f"Line {number}: popularity must be a whole number, "
+                                   f"not {parts[2]!r}.") from None
+            word = normalize(parts[0])
+            if word:
+                yield (word, parts[1], popularity)
+
+    def read_cmudict(self, f):
+        """Yield (word, stresses, 1) from CMUdict lines, one per pronunciation."""
+        for line in f:
+            if not line.strip() or line.startswith(";;;"):
+                continue
+            parts = line.split()
+            word = normalize(cmudict_variant.sub("", parts[0]))
+            # vowels carry a stress digit: 1 primary, 2 secondary, 0 none
+            digits = cmudict_stress.findall(" ".join(parts[1:]))
+            stresses = "".join("/" if d == "1" else self.secondary if d == "2" else "u"
+                               for d in digits)
+            if word and stresses:
+                yield (word, stresses, 1)
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Poem, WordOccurrence
+from app.scan import LOOKUP_BATCH_SIZE, poem_words
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the word occurrence index sweep_scansions uses to find the "
+            "poems affected by changes to the lexicon.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500,
+                            help="number of poems indexed per transaction")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        start = time.perf_counter()
+        indexed = 0
+        last = 0
+        while True:
+            poems = list(Poem.objects.filter(pk__gt=last).order_by("pk")
+                         .only("id", "poem")[:chunk_size])
+            if not poems:
+                break
+            last = poems[-1].pk
+            # replace each chunk's rows wholesale rather than diffing them
+            with transaction.atomic():
+                WordOccurrence.objects.filter(poem__in=poems).delete()
+                WordOccurrence.objects.bulk_create(
+                    [WordOccurrence(word=word, poem=poem)
+                     for poem in poems for word in poem_words(poem.poem)],
+                    batch_size=LOOKUP_BATCH_SIZE)
+            indexed += len(poems)
+            if options["verbosity"] > 1:
+                self.report(indexed, start)
+        self.report(indexed, start)
+
+    def report(self, indexed, start):
+        elapsed = time.perf_counter() - start
+        rate = indexed / elapsed if elapsed else 0.0
+        self.stdout.write(f"Indexed {indexed} poems ({rate:.1f} poems/second).")
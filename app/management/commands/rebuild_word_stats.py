@@ -0,0 +1,94 @@
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from app.models import Pronunciation, WordStats
+from app.scan import LOOKUP_BATCH_SIZE, bump_generation, clear_caches, pattern_stats
+
+
+class Command(BaseCommand):
+    help = ("Bring the precomputed WordStats table up to date with Pronunciation. "
+            "Run it after changing Pronunciation other than through scanning, "
+            "import_lexicon or the admin (e.g. with loaddata).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000,
+                            help="number of words compared per batch")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        rows = (Pronunciation.objects
+                .order_by("word", "pk")
+                .values_list("word", "stresses", "popularity")
+                .iterator(chunk_size=batch_size))
+        self.now = timezone.now()
+        # bumped the first time a row is created or its stats change, so
+        # that stored scansions of only those words are taken for stale
+        self.generation = None
+        self.counts = {"created": 0, "updated": 0, "unchanged": 0}
+        with transaction.atomic():
+            batch = {}
+            skipped = []
+            # rows arrive sorted by word, so each group is one word's patterns
+            for word, group in groupby(rows, key=lambda row: row[0]):
+                try:
+                    batch[word] = pattern_stats([row[1:] for row in group])
+                # a lone pattern with popularity 0 has no ratio; skip it
+                except ZeroDivisionError:
+                    skipped.append(word)
+                    continue
+                if len(batch) >= batch_size:
+                    self.write_batch(batch)
+                    batch = {}
+            self.write_batch(batch)
+            # and drop the rows of words with no usable patterns left
+            removed = (WordStats.objects.exclude(word__in=Pronunciation.objects.values("word"))
+                       .delete()[0])
+            for i in range(0, len(skipped), LOOKUP_BATCH_SIZE):
+                removed += WordStats.objects.filter(
+                    word__in=skipped[i:i + LOOKUP_BATCH_SIZE]).delete()[0]
+        clear_caches()
+        total = self.counts["created"] + self.counts["updated"] + self.counts["unchanged"]
+        self.stdout.write(f"Rebuilt stats for {total} words ({self.counts['created']} created, "
+                          f"{self.counts['updated']} updated, {removed} removed).")
+
+    def write_batch(self, batch):
+        """Create or update the rows of words in batch whose stats changed.
+
+        Unchanged rows are not written, so their `updated` timestamps
+        (which the compiled lexicon checks) and generations are kept.
+        """
+        words = list(batch)
+        existing = {}
+        for i in range(0, len(words), LOOKUP_BATCH_SIZE):
+            existing.update((ws.word, ws) for ws in
+                            WordStats.objects.filter(word__in=words[i:i + LOOKUP_BATCH_SIZE]))
+        to_create = []
+        to_update = []
+        for word, (values, popularity) in batch.items():
+            ws = existing.get(word)
+            if ws is None:
+                to_create.append(WordStats(word=word, syllables=len(values),
+                                           ratios=values, popularity=popularity))
+            elif (ws.ratios, ws.popularity, ws.syllables) != (values, popularity, len(values)):
+                ws.ratios = values
+                ws.popularity = popularity
+                ws.syllables = len(values)
+                ws.updated = self.now
+                to_update.append(ws)
+            else:
+                self.counts["unchanged"] += 1
+        # new rows count as changes too: their words may have been added
+        # (say, by loaddata) after scansions of poems with them were stored
+        if (to_create or to_update) and self.generation is None:
+            self.generation = bump_generation()
+        for ws in to_create + to_update:
+            ws.generation = self.generation
+        WordStats.objects.bulk_create(to_create, batch_size=LOOKUP_BATCH_SIZE)
+        WordStats.objects.bulk_update(to_update, ["ratios", "popularity", "syllables",
+                                                  "updated", "generation"],
+                                      batch_size=LOOKUP_BATCH_SIZE)
+        self.counts["created"] += len(to_create)
+        self.counts["updated"] += len(to_update)
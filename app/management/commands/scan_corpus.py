@@ -0,0 +1,131 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import Algorithm, Poem, PoemScansion
+from app.parallel import parallel_scan_all
+from app.scan import sync_lexicon
+
+
+class Command(BaseCommand):
+    help = "Scan stored poems in batches and save their PoemScansions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--algorithm", action="append", dest="algorithms",
+                            metavar="FUNCTION_NAME",
+                            help="only run this algorithm (may be repeated); default: all")
+        human = parser.add_mutually_exclusive_group()
+        human.add_argument("--human-scanned", action="store_true",
+                           help="only scan poems a human has scanned")
+        human.add_argument("--computer-scanned", action="store_true",
+                           help="only scan poems no human has scanned yet")
+        parser.add_argument("--min-id", type=int, help="lowest poem id to scan")
+        parser.add_argument("--max-id", type=int, help="highest poem id to scan")
+        parser.add_argument("--chunk-size", type=int, default=100,
+                            help="number of poems fetched and written per batch")
+        parser.add_argument("--force", action="store_true",
+                            help="rescan poems that already have a scansion")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="number of processes to scan each batch on (default: 1)")
+
+    def handle(self, *args, **options):
+        algorithms = Algorithm.objects.all()
+        if options["algorithms"]:
+            algorithms = algorithms.filter(function_name__in=options["algorithms"])
+            unknown = set(options["algorithms"]) - {a.function_name for a in algorithms}
+            if unknown:
+                raise CommandError(f"Unknown algorithm(s): {', '.join(sorted(unknown))}")
+        algorithms = list(algorithms)
+        if not algorithms:
+            raise CommandError("There are no algorithms to run.")
+
+        poems = Poem.objects.only("id", "poem").order_by("id")
+        if options["human_scanned"]:
+            poems = poems.filter(human_scanned=True)
+        elif options["computer_scanned"]:
+            poems = poems.filter(human_scanned=False)
+        if options["min_id"] is not None:
+            poems = poems.filter(pk__gte=options["min_id"])
+        if options["max_id"] is not None:
+            poems = poems.filter(pk__lte=options["max_id"])
+
+        self.workers = options["workers"]
+        chunk_size = options["chunk_size"]
+        start = time.perf_counter()
+        scanned = 0
+        written = 0
+        batch = []
+        # stream poems so memory use does not depend on the size of the table
+        for poem in poems.iterator(chunk_size=chunk_size):
+            batch.append(poem)
+            if len(batch) >= chunk_size:
+                written += self.scan_batch(batch, algorithms, options["force"])
+                scanned += len(batch)
+                batch = []
+                self.report(scanned, written, start, options["verbosity"] > 1)
+        if batch:
+            written += self.scan_batch(batch, algorithms, options["force"])
+            scanned += len(batch)
+        self.report(scanned, written, start, True)
+
+    def scan_batch(self, poems, algorithms, force):
+        """Scan one batch of poems and write their scansions.
+
+        Returns the number of PoemScansion rows created or updated, not
+        counting new rows skipped because another process stored them first.
+        """
+        # read the generation before the stored scansions and before
+        # scanning, so no row is marked up to date with changes made after
+        # it was read
+        generation = sync_lexicon()
+        stored = PoemScansion.objects.filter(poem__in=poems, type__in=algorithms)
+        existing = {}
+        for scansion in stored:
+            existing[(scansion.poem_id, scansion.type_id)] = scansion
+        needed = {}
+        for poem in poems:
+            if force:
+                needed[poem] = algorithms
+            else:
+                needed[poem] = [a for a in algorithms if (poem.pk, a.pk) not in existing]
+        # scan every poem that needs anything with every algorithm any of
+        # them needs, off one lexicon lookup for the whole batch (fanned out
+        # over worker processes if there is more than one)
+        todo = [poem for poem in poems if needed[poem]]
+        if not todo:
+            return 0
+        names = sorted({a.function_name for poem in todo for a in needed[poem]})
+        results = dict(zip(todo, parallel_scan_all([poem.poem for poem in todo],
+                                                   names, self.workers)))
+        to_create = []
+        to_update = []
+        for poem in poems:
+            for algorithm in needed[poem]:
+                scansion = existing.get((poem.pk, algorithm.pk))
+                if scansion is None:
+                    to_create.append(PoemScansion(poem=poem, type=algorithm,
+                                                  scansion=results[poem][algorithm.function_name],
+                                                  generation=generation))
+                else:
+                    scansion.scansion = results[poem][algorithm.function_name]
+                    scansion.generation = generation
+                    to_update.append(scansion)
+        # a scansion another process (such as the automated view) stored
+        # while the batch was scanned is kept rather than failing the run,
+        # even if it is stored between the check below and the insert
+        if to_create:
+            # leave out (and do not count) those stored since existing was read
+            stored_since = set(stored.values_list("poem_id", "type_id"))
+            to_create = [scansion for scansion in to_create
+                         if (scansion.poem_id, scansion.type_id) not in stored_since]
+            PoemScansion.objects.bulk_create(to_create, ignore_conflicts=True)
+        PoemScansion.objects.bulk_update(to_update, ["scansion", "generation"])
+        return len(to_create) + len(to_update)
+
+    def report(self, scanned, written, start, show):
+        if not show:
+            return
+        elapsed = time.perf_counter() - start
+        rate = scanned / elapsed if elapsed else 0.0
+        self.stdout.write(f"Scanned {scanned} poems ({rate:.1f} poems/second), "
+                          f"wrote {written} scansions.")
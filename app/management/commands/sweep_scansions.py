@@ -0,0 +1,66 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Min
+
+from app.models import LexiconState, PoemScansion
+from app.scan import changed_poem_ids, refresh_scansions, sync_lexicon
+
+
+class Command(BaseCommand):
+    help = ("Bring stored PoemScansions up to date with the lexicon, rescanning "
+            "only poems with words recorded since their oldest scansion was stored "
+            "(found through the word occurrence index; see index_poems).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=100,
+                            help="number of poems checked per batch")
+        parser.add_argument("--all", action="store_true",
+                            help="check every scansion behind the current generation "
+                                 "instead of only those of poems with changed words")
+        parser.add_argument("--force", action="store_true",
+                            help="rescan every scansion checked, even if none of its "
+                                 "words changed")
+
+    def handle(self, *args, **options):
+        generation = sync_lexicon()
+        state = LexiconState.objects.filter(pk=1)
+        behind = PoemScansion.objects.filter(generation__lt=generation)
+        # scansions stored with a generation read before the last sweep
+        # (say, by a long scan_corpus run) can be older than it, so look
+        # back to the oldest one left behind
+        oldest = behind.aggregate(oldest=Min("generation"))["oldest"]
+        if oldest is not None and not options["all"]:
+            candidates = changed_poem_ids(oldest, generation)
+            # poems without changed words are up to date as they are
+            behind.exclude(poem_id__in=candidates).update(generation=generation)
+            behind = behind.filter(poem_id__in=candidates)
+        chunk_size = options["chunk_size"]
+        start = time.perf_counter()
+        checked = 0
+        rescanned = 0
+        last = 0
+        while True:
+            # page through poems by id: rows are updated as they are swept,
+            # so they cannot be streamed from a single query
+            poem_ids = list(behind.filter(poem_id__gt=last).order_by("poem_id")
+                            .values_list("poem_id", flat=True).distinct()[:chunk_size])
+            if not poem_ids:
+                break
+            last = poem_ids[-1]
+            by_poem = {}
+            for scansion in behind.filter(poem_id__in=poem_ids).select_related("poem", "type"):
+                by_poem.setdefault(scansion.poem_id, []).append(scansion)
+            for scansions in by_poem.values():
+                rescanned += len(refresh_scansions(scansions[0].poem.poem, scansions,
+                                                   generation, force=options["force"]))
+                checked += len(scansions)
+            if options["verbosity"] > 1:
+                self.report(checked, rescanned, start)
+        state.filter(swept_generation__lt=generation).update(swept_generation=generation)
+        self.report(checked, rescanned, start)
+
+    def report(self, checked, rescanned, start):
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Checked {checked} scansions in {elapsed:.1f}s, "
+                          f"rescanned {rescanned}.")
@@ -0,0 +1,245 @@
+"""MODULE METRICS
+==================
+This module keeps in-process metrics of the scan pipeline.
+
+`scan.py` times its stages (tokenizing, lexicon lookup, the syllable
+count fallback and each algorithm) into `Histogram`s and counts the
+words, unknown words and syllables of every poem it computes stress
+ratios for. The /metrics view renders them in the Prometheus text
+format, so p50/p99 per stage can be taken with `histogram_quantile`.
+
+Metrics are per process: scans run by `parallel.py`'s worker processes
+are not counted. Set SCAN_METRICS to False to skip collecting them.
+
+Classes
+-------
+
+Counter : Monotonic counter with labels.
+Histogram : Distribution of observed values in fixed buckets.
+
+Functions
+---------
+
+timed(histogram, **labels) : Time a block or function into histogram.
+record_scan(words, unknown, syllables) : Count one poem's words.
+render() : Return every metric in Prometheus text format.
+reset() : Zero every metric.
+"""
+
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.conf import settings
+
+# upper bounds, in seconds, of the buckets stage timings are counted in
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = getattr(settings, "SCAN_METRICS", True)
+
+# every metric, in the order they are rendered
+registry = []
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values, extra=()):
+    """Return a Prometheus label set such as {stage="lookup"}."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    """Monotonic counter, one value per combination of labels.
+
+    Parameters
+    ----------
+    name, documentation : str
+        metric name and HELP text
+
+    labels : tuple, optional
+        label names; `inc` takes a value for each as a keyword
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the value for labels."""
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(labels[name] for name in self.labels), 0)
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"
+
+class Histogram:
+    """Distribution of observed values, one per combination of labels.
+
+    Counts are kept per bucket (the last for values above every bound)
+    and made cumulative when rendered, as Prometheus expects.
+
+    Parameters
+    ----------
+    name, documentation : str
+        metric name and HELP text
+
+    labels : tuple, optional
+        label names; `observe` takes a value for each as a keyword
+
+    buckets : tuple, optional
+        increasing bucket upper bounds; TIME_BUCKETS by default
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        """Count value in the distribution for labels."""
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels):
+        entry = self.values.get(tuple(labels[name] for name in self.labels))
+        return sum(entry[0]) if entry else 0
+
+    def quantile(self, q, **labels):
+        """Estimate the q quantile for labels the way histogram_quantile does.
+
+        Returns None if nothing was observed, and the largest bucket bound
+        if the quantile falls above it.
+        """
+        entry = self.values.get(tuple(labels[name] for name in self.labels))
+        if not entry or not sum(entry[0]):
+            return None
+        counts = entry[0]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts[:-1]):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                # interpolate linearly within the bucket
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def reset(self):
+        with self.lock:
+            self.values.clear()
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = bound if bound == "+Inf" else format_value(bound)
+                yield (f"{self.name}_bucket{format_labels(self.labels, key, [('le', le)])} "
+                       f"{cumulative}")
+            yield f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, key)} {cumulative}"
+
+stage_seconds = Histogram("scan_stage_seconds",
+                          "Time spent in each stage of scanning (lookup includes syllables).",
+                          labels=("stage",))
+algorithm_seconds = Histogram("scan_algorithm_seconds",
+                              "Time spent running each scansion algorithm on a poem.",
+                              labels=("algorithm",))
+poems_total = Counter("scan_poems_total",
+                      "Poems stress ratios were computed for.")
+words_total = Counter("scan_words_total",
+                      "Words in the poems stress ratios were computed for.")
+unknown_words_total = Counter("scan_unknown_words_total",
+                              "Words with neither a recorded nor a derived stress pattern.")
+syllables_total = Counter("scan_syllables_total",
+                          "Syllables in the poems stress ratios were computed for.")
+
+# (histogram, labels) pairs being timed on each thread, so that a stage
+# calling itself (as lexicon_stats does for stems) is only counted once
+active = threading.local()
+
+@contextmanager
+def timed(histogram, **labels):
+    """Time the block (or, as a decorator, each call) into histogram.
+
+    Timings nested in one of the same histogram and labels are not
+    observed separately.
+    """
+    if not enabled:
+        yield
+        return
+    running = active.__dict__.setdefault("running", set())
+    key = (histogram.name, tuple(sorted(labels.items())))
+    if key in running:
+        yield
+        return
+    running.add(key)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        running.discard(key)
+        histogram.observe(time.perf_counter() - start, **labels)
+
+def record_scan(words, unknown, syllables):
+    """Count the words, unknown words and syllables of one scanned poem."""
+    if not enabled:
+        return
+    poems_total.inc()
+    words_total.inc(words)
+    unknown_words_total.inc(unknown)
+    syllables_total.inc(syllables)
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+def reset():
+    """Zero every metric."""
+    for metric in registry:
+        metric.reset()
@@ -0,0 +1,122 @@
+"""MODULE MIDDLEWARE
+====================
+This module measures the database work behind each request.
+
+`QueryLogMiddleware` wraps every query a view runs with a
+`QueryRecorder` and logs how many there were, how long they took in
+total and the slowest of them to the "app.queries" logger, with the
+numbers attached to the log record as `query_stats` for structured
+handlers. It is opt-in: unless SCAN_QUERY_LOGGING is set, Django drops
+it from the middleware chain when the server starts.
+
+Only queries run on the request's thread are seen; the async views'
+scans run in `scan_executor`, whose threads have their own connections.
+
+Classes
+-------
+
+QueryRecorder : Execute wrapper counting and timing queries.
+QueryLogMiddleware : Log the queries of every request.
+"""
+
+
+import heapq
+import logging
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+
+logger = logging.getLogger("app.queries")
+
+
+class QueryRecorder:
+    """Execute wrapper counting and timing the queries run inside it.
+
+    Use as a context manager to install it on every database connection
+    of the current thread.
+
+    Parameters
+    ----------
+    slowest : int, optional
+        Number of slowest statements to keep. The default is 3.
+
+    Attributes
+    ----------
+    count : int
+        Number of queries run.
+    seconds : float
+        Total time spent running them.
+    """
+
+    def __init__(self, slowest=3):
+        self.keep = slowest
+        self.count = 0
+        self.seconds = 0.0
+        # min-heap of (seconds, order, sql), so the fastest is dropped first
+        self.heap = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+            if self.keep:
+                item = (elapsed, self.count, sql)
+                if len(self.heap) < self.keep:
+                    heapq.heappush(self.heap, item)
+                else:
+                    heapq.heappushpop(self.heap, item)
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        for connection in connections.all():
+            self.stack.enter_context(connection.execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.stack.__exit__(*exc_info)
+
+    def slowest(self):
+        """Return the slowest statements as (sql, seconds), slowest first."""
+        return [(sql, seconds) for seconds, order, sql in sorted(self.heap, reverse=True)]
+
+    def stats(self):
+        """Return the counts and timings as a JSON-serializable dict."""
+        return {"queries": self.count,
+                "sql_ms": round(self.seconds * 1000, 3),
+                "slowest": [{"sql": sql, "ms": round(seconds * 1000, 3)}
+                            for sql, seconds in self.slowest()]}
+
+
+class QueryLogMiddleware:
+    """Log the query count, SQL time and slowest statements of each request.
+
+    Enabled by SCAN_QUERY_LOGGING, keeping SCAN_QUERY_LOG_SLOWEST
+    statements per request.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "SCAN_QUERY_LOGGING", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slowest = getattr(settings, "SCAN_QUERY_LOG_SLOWEST", 3)
+
+    def __call__(self, request):
+        with QueryRecorder(self.slowest) as recorder:
+            response = self.get_response(request)
+        match = request.resolver_match
+        stats = {"method": request.method,
+                 "path": request.path,
+                 "view": match.view_name if match else None,
+                 "status": response.status_code,
+                 **recorder.stats()}
+        logger.info("%s %s (%s): %d queries in %.1f ms", stats["method"], stats["path"],
+                    stats["view"], stats["queries"], stats["sql_ms"],
+                    extra={"query_stats": stats})
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_alter_pronunciation_popularity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word', models.CharField(max_length=50, unique=True)),
+                ('syllables', models.IntegerField()),
+                ('ratios', models.JSONField(default=list)),
+                ('popularity', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:50
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_pronunciations(apps, schema_editor):
+    # fold repeated (word, stresses) rows into the oldest one, adding up
+    # their popularities, so the unique constraint can be created
+    Pronunciation = apps.get_model('app', 'Pronunciation')
+    duplicates = (Pronunciation.objects
+                  .values('word', 'stresses')
+                  .annotate(rows=Count('id'), first=Min('id'), total=Sum('popularity'))
+                  .filter(rows__gt=1))
+    for duplicate in duplicates:
+        Pronunciation.objects.filter(pk=duplicate['first']).update(popularity=duplicate['total'])
+        (Pronunciation.objects
+         .filter(word=duplicate['word'], stresses=duplicate['stresses'])
+         .exclude(pk=duplicate['first'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_wordstats'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_pronunciations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='pronunciation',
+            constraint=models.UniqueConstraint(fields=('word', 'stresses'), name='unique_pronunciation'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_unique_pronunciation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wordstats',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+def create_lexicon_state(apps, schema_editor):
+    LexiconState = apps.get_model("app", "LexiconState")
+    LexiconState.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_wordstats_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LexiconState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_lexicon_state, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='poemscansion',
+            name='generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='wordstats',
+            name='generation',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+    ]
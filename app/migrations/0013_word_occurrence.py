@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_lexicon_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lexiconstate',
+            name='swept_generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='WordOccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word', models.CharField(max_length=50)),
+                ('poem', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.poem')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='wordoccurrence',
+            constraint=models.UniqueConstraint(fields=('word', 'poem'), name='unique_word_occurrence'),
+        ),
+    ]
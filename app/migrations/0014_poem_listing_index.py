@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_word_occurrence'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='poem',
+            index=models.Index(fields=['human_scanned', 'poet'], name='poem_listing'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:19
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_scansions(apps, schema_editor):
+    # keep the latest scansion of each poem by each algorithm
+    PoemScansion = apps.get_model("app", "PoemScansion")
+    latest = (PoemScansion.objects.values("poem", "type")
+              .annotate(latest=Max("id")).values("latest"))
+    PoemScansion.objects.exclude(id__in=latest).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_poem_listing_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_scansions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='poemscansion',
+            constraint=models.UniqueConstraint(fields=('poem', 'type'), name='unique_poem_scansion'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:02
+
+from django.db import migrations
+
+from app.scan import LOOKUP_BATCH_SIZE, poem_words
+
+
+def index_poems(apps, schema_editor):
+    # fill the word occurrence index for poems stored before it existed
+    # (as the index_poems command does, for poems that have no rows yet)
+    Poem = apps.get_model("app", "Poem")
+    WordOccurrence = apps.get_model("app", "WordOccurrence")
+    poems = (Poem.objects.filter(wordoccurrence__isnull=True)
+             .order_by("pk").only("id", "poem"))
+    last = 0
+    while True:
+        chunk = list(poems.filter(pk__gt=last)[:500])
+        if not chunk:
+            break
+        last = chunk[-1].pk
+        WordOccurrence.objects.bulk_create(
+            [WordOccurrence(word=word, poem=poem)
+             for poem in chunk for word in poem_words(poem.poem)],
+            batch_size=LOOKUP_BATCH_SIZE, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_unique_poem_scansion'),
+    ]
+
+    operations = [
+        migrations.RunPython(index_poems, migrations.RunPython.noop),
+    ]
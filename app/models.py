@@ -14,9 +14,35 @@ class Pronunciation(models.Model):
     stresses = models.CharField(max_length=20, blank=True)
     popularity = models.IntegerField(default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["word", "stresses"], name="unique_pronunciation")
+        ]
+
     def __str__(self):
         return f"{self.word}, {self.stresses}, popularity: {self.popularity}"
 
+class WordStats(models.Model):
+    word = models.CharField(max_length=50, unique=True)
+    syllables = models.IntegerField()
+    ratios = models.JSONField(default=list)
+    popularity = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+    # lexicon generation in which the word's stats last changed
+    generation = models.IntegerField(default=0, db_index=True)
+
+    def __str__(self):
+        return f"{self.word}, {self.ratios}, popularity: {self.popularity}"
+
+class LexiconState(models.Model):
+    # a single row; generation goes up by one every time patterns change
+    generation = models.IntegerField(default=0)
+    # generation the sweep_scansions command last brought PoemScansions up to
+    swept_generation = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Lexicon generation {self.generation}"
+
 class Poem(models.Model):
     title = models.TextField(blank=True)
     poem = models.TextField()
@@ -24,9 +50,29 @@ class Poem(models.Model):
     human_scanned = models.BooleanField(default=False)
     poet = models.TextField(blank=True)
 
+    class Meta:
+        indexes = [
+            # choose_poem lists each kind of poem by poet
+            models.Index(fields=["human_scanned", "poet"], name="poem_listing")
+        ]
+
     def __str__(self):
         return f"{self.title} by {self.poet}, human-scanned: {self.human_scanned}"
 
+class WordOccurrence(models.Model):
+    # normalized word (or stem it could be inflected from) found in poem;
+    # the unique constraint's index serves lookups by word
+    word = models.CharField(max_length=50)
+    poem = models.ForeignKey(Poem, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["word", "poem"], name="unique_word_occurrence")
+        ]
+
+    def __str__(self):
+        return f"{self.word} in poem {self.poem_id}"
+
 class Algorithm(models.Model):
     name = models.TextField()
     about = models.TextField()
@@ -40,6 +86,14 @@ class PoemScansion(models.Model):
     poem = models.ForeignKey(Poem, on_delete=models.CASCADE)
     scansion = models.TextField()
     type = models.ForeignKey(Algorithm, on_delete=models.CASCADE)
+    # lexicon generation the scansion is known to be up to date with
+    generation = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # one scansion of each poem per algorithm
+            models.UniqueConstraint(fields=["poem", "type"], name="unique_poem_scansion")
+        ]
 
     def __str__(self):
         return f"{self.poem.title}, {self.type.name}"
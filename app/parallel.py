@@ -0,0 +1,120 @@
+"""MODULE PARALLEL
+===================
+This module scans many poems at once on a pool of worker processes.
+
+The parent process looks up the stats of every word in the batch with
+one `scan.lexicon_stats` call and hands the result to the workers as a
+read-only snapshot. With the fork start method the snapshot is simply
+inherited (and shared copy-on-write), so workers never open a database
+connection or query Pronunciation themselves. If a compiled lexicon
+file is available, workers map it instead, and the snapshot only holds
+the words the file cannot answer for.
+
+Functions
+---------
+
+parallel_scan_all(poems, names, workers=None) : scan_all over many poems.
+"""
+
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# lexicon snapshot of the current worker process, set by init_worker
+snapshot = None
+
+class SnapshotLexicon:
+    """Stats lookup over a snapshot dict backed by a compiled lexicon.
+
+    Parameters
+    ----------
+    snapshot : dict
+        lexicon_stats output for words the compiled lexicon lacks
+
+    reader : scan.CompiledLexicon
+        memory-mapped compiled lexicon for every other word
+    """
+    __slots__ = ("snapshot", "reader")
+
+    def __init__(self, snapshot, reader):
+        self.snapshot = snapshot
+        self.reader = reader
+
+    def __getitem__(self, word):
+        found = self.snapshot.get(word)
+        if found is None:
+            found = self.reader.get(word)
+        return found
+
+def init_worker(lexicon, path):
+    """Store the lexicon snapshot in a freshly started worker.
+
+    If path is given, the compiled lexicon there is mapped and used for
+    every word the snapshot lacks.
+    """
+    global snapshot
+    # workers started with spawn have to set Django up before app.scan
+    # (and through it app.models) can be imported
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+    if path is not None:
+        from .scan import CompiledLexicon
+        lexicon = SnapshotLexicon(lexicon, CompiledLexicon(path))
+    snapshot = lexicon
+
+def scan_in_worker(poem, names):
+    """Run scan_all on one poem against the worker's lexicon snapshot."""
+    from .scan import scan_all
+    return scan_all(poem, names, lexicon=snapshot)
+
+def parallel_scan_all(poems, names, workers=None):
+    """Scan many poems with several algorithms on a process pool.
+
+    Parameters
+    ----------
+    poems : iterable
+        poem texts to scan
+
+    names : list
+        keys of scan.SCANS (Algorithm function_names) to run
+
+    workers : int, optional
+        number of worker processes; defaults to the number of CPUs
+
+    Returns
+    -------
+    results : list
+        scan_all(poem, names) for each poem, in input order
+    """
+    from .scan import compiled_lexicon, lexicon_stats, scan_all, tokenize
+    poems = list(poems)
+    if not poems or not names:
+        return [{} for poem in poems]
+    words = {token.norm for poem in poems for tokens in tokenize(poem) for token in tokens}
+    # with a compiled lexicon, only words it cannot answer for need a snapshot
+    reader = compiled_lexicon()
+    path = None
+    if reader is not None:
+        reader.refresh_stale()
+        words = [word for word in words if reader.lookup(word) is None]
+        path = reader.path
+    # look up every remaining word of every poem in the parent, once
+    lexicon = lexicon_stats(words)
+    workers = min(workers or os.cpu_count() or 1, len(poems))
+    if workers <= 1:
+        if reader is not None:
+            lexicon = SnapshotLexicon(lexicon, reader)
+        return [scan_all(poem, names, lexicon=lexicon) for poem in poems]
+    # prefer fork, which shares the snapshot with workers without pickling it
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    chunksize = max(1, len(poems) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(lexicon, path)) as pool:
+        return list(pool.map(scan_in_worker, poems, repeat(names), chunksize=chunksize))
@@ -0,0 +1,155 @@
+"""MODULE PICKER
+=================
+This module picks random poems without sorting the Poem table.
+
+The ids of all poems and of human-scanned poems are loaded once into
+`IdSample`s, which add, remove and pick ids in constant time. Poem
+signals (see `signals.py`) keep them up to date as poems are imported or
+scanned by users, and they are reloaded every SCAN_POEM_IDS_TTL seconds
+to pick up changes made by other processes.
+
+Classes
+-------
+
+IdSample : Set of ids that can return a random member in O(1).
+PoemPicker : Random poem selection from cached id samples.
+"""
+
+
+import random
+import threading
+import time
+from django.conf import settings
+from .models import Poem
+
+
+class IdSample:
+    """Set of ids that can return a random member in constant time.
+
+    Ids are kept in a list for `random.choice`, with each id's position
+    in a dict so that removing it swaps the last id into its place.
+    """
+
+    def __init__(self, ids=()):
+        self.ids = []
+        self.positions = {}
+        for pk in ids:
+            self.add(pk)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, pk):
+        return pk in self.positions
+
+    def add(self, pk):
+        if pk not in self.positions:
+            self.positions[pk] = len(self.ids)
+            self.ids.append(pk)
+
+    def discard(self, pk):
+        position = self.positions.pop(pk, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != pk:
+            self.ids[position] = last
+            self.positions[last] = position
+
+    def choice(self):
+        """Return a random id, or None if there are none."""
+        return random.choice(self.ids) if self.ids else None
+
+
+class PoemPicker:
+    """Pick random poems, or random human-scanned poems, in constant time.
+
+    Parameters
+    ----------
+    ttl : float
+        seconds after which the ids are reloaded from the database
+
+    retries : int, default: 3
+        ids tried before giving up on ones that are out of date
+    """
+
+    def __init__(self, ttl, retries=3):
+        self.ttl = ttl
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.all = None
+        self.human = None
+        self.loaded_at = 0.0
+
+    def samples(self):
+        """Return the (all, human-scanned) samples, loading them if needed."""
+        with self.lock:
+            if self.all is None or time.monotonic() - self.loaded_at > self.ttl:
+                rows = Poem.objects.values_list("id", "human_scanned")
+                self.all = IdSample()
+                self.human = IdSample()
+                for pk, human_scanned in rows.iterator():
+                    self.all.add(pk)
+                    if human_scanned:
+                        self.human.add(pk)
+                self.loaded_at = time.monotonic()
+            return self.all, self.human
+
+    def invalidate(self):
+        """Reload the ids the next time a poem is picked."""
+        with self.lock:
+            self.all = None
+            self.human = None
+
+    def saved(self, pk, human_scanned):
+        """Record that poem pk was saved, if the ids are loaded."""
+        with self.lock:
+            if self.all is None:
+                return
+            self.all.add(pk)
+            if human_scanned:
+                self.human.add(pk)
+            else:
+                self.human.discard(pk)
+
+    def deleted(self, pk):
+        """Record that poem pk was deleted, if the ids are loaded."""
+        with self.lock:
+            if self.all is None:
+                return
+            self.all.discard(pk)
+            self.human.discard(pk)
+
+    def random_poem(self, human_scanned=False):
+        """Return a random poem, or None if there are none.
+
+        Parameters
+        ----------
+        human_scanned : bool, default: False
+            only pick from poems a human has scanned
+
+        Returns
+        -------
+        poem : Poem or None
+        """
+        for attempt in range(self.retries + 1):
+            if attempt == self.retries:
+                # too many ids were out of date: start over from the database
+                self.invalidate()
+            all_ids, human_ids = self.samples()
+            with self.lock:
+                pk = (human_ids if human_scanned else all_ids).choice()
+            if pk is None:
+                return None
+            poem = Poem.objects.filter(pk=pk).first()
+            if poem is not None and (poem.human_scanned or not human_scanned):
+                return poem
+            # another process deleted the poem or changed it
+            if poem is None:
+                self.deleted(pk)
+            else:
+                self.saved(pk, poem.human_scanned)
+        return None
+
+
+poem_picker = PoemPicker(getattr(settings, "SCAN_POEM_IDS_TTL", 300))
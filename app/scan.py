@@ -5,22 +5,1009 @@ This module scans poems and records users' scansions.
 Functions
 ---------
 
+normalize(word) : Strip punctuation from word and lowercase it.
+tokenize(poem) : Split poem into lines of normalized Tokens.
+pattern_stats(patterns) : Calculate ratios from a word's stress patterns.
+fetch_patterns(words) : Fetch stress patterns of many words in one query.
+learn_words(words) : Add newly known words to the stem index.
+candidate_stems(word) : Yield the stems word could be inflected from.
+derive_stems(words) : Find the longest known stem of unknown words.
+lexicon_stats(words) : Look up ratios for many words in one query.
+refresh_word_stats(words) : Recompute precomputed ratios of words.
+bump_lexicon_version() : Mark every cached scansion as out of date.
+poem_words(poem) : Words (and possible stems) a poem is indexed under.
+index_poem(poem) : Update the WordOccurrence rows of a saved poem.
+changed_poem_ids(since, until) : Poems with words changed in between.
+poem_key(lines) : Hash the normalized words of a tokenized poem.
+bump_generation() : Increment the database lexicon generation.
+lexicon_generation() : Return the database lexicon generation.
+sync_lexicon() : Drop cached stats of words other processes changed.
+words_generation(words) : Latest generation in which any of words changed.
+stale_scansions(poem, scansions, generation) : Stored scansions to rescan.
+refresh_scansions(poem, scansions, generation) : Rescan outdated scansions.
+clear_caches() : Empty the stats and scansion caches and the stem index.
+compiled_lexicon() : Return the memory-mapped compiled lexicon, if any.
+stats_cache_info() : Report hits, misses and size of the stats cache.
 get_stats(word, confidence=False) : Return ratio to calculate scansion.
 poem_stats(poem) : Use get_stats on whole poem and return nested list.
 original_scan(poem) : Scan by comparing each ratio to the next.
+house_robber_line(line) : Scan one line of ratios in linear time.
 house_robber_scan(poem) : Scan with solution to house robber problem
 prose_scan(poem) : Scan based on ratios with no comparisons.
+scan_all(poem, names, lexicon=None) : Run several algorithms off one lookup.
+add_popularities(increments) : Atomically add to many patterns' popularity.
+forget_words(words, generation) : Drop cached stats of changed words.
+pronunciations_changed(words) : Update stats after editing patterns directly.
 record(poem, scansion) : Record new user scansions in database.
 syllables(word) : Guess syllable count of word not in database.
+syllables_many(words) : Guess syllable counts of many words at once.
+count_syllables(word_lower) : Memoized syllable guess for lowercase word.
 """
 
 
+import hashlib
+import mmap
+import os
 import re
-from .models import Pronunciation
-from copy import copy
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, Max, OuterRef, Q
+from django.utils import timezone
+from .models import LexiconState, Poem, Pronunciation, PoemScansion, WordOccurrence, WordStats
+from . import metrics, vectorized
 
 newline = re.compile("\r\n|\n|\r")
 disallowed = re.compile("[^A-Za-zé]")
+# number of words looked up per query, kept under SQLite's parameter limit
+LOOKUP_BATCH_SIZE = 500
+
+class LRUCache:
+    """Bounded, thread-safe mapping that evicts least recently used keys.
+
+    Parameters
+    ----------
+    maxsize : int
+        maximum number of entries kept; 0 disables caching
+
+    Attributes
+    ----------
+    hits, misses : int
+        number of successful and failed `get` calls since last `clear`
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return cached value for key (marking it recently used) or default."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Cache value under key, evicting the oldest entry if full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop key from the cache if it is there."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose value predicate returns true for."""
+        with self._lock:
+            for key in [key for key, value in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return hit, miss and size counters as a dict."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._data), "maxsize": self.maxsize}
+
+# computed (values, popularity) for normalized words, invalidated by record
+stats_cache = LRUCache(getattr(settings, "SCAN_STATS_CACHE_SIZE", 10000))
+
+# scansions by (poem_key, algorithm name, lexicon version); entries for
+# older versions are never hit again and age out of the cache
+scansion_cache = LRUCache(getattr(settings, "SCAN_SCANSION_CACHE_SIZE", 1000))
+# incremented whenever stress patterns change (see bump_lexicon_version)
+lexicon_version = 0
+# the database lexicon generation the caches are up to date with, if known
+# (see sync_lexicon)
+synced_generation = None
+
+# layout of a compiled lexicon file (see the compile_lexicon command):
+# a header, a table of record offsets sorted by the word's UTF-8 bytes,
+# then one record per word: word length (in bytes), word, number of
+# ratios, popularity and the ratios as doubles, all little-endian
+LEXICON_MAGIC = b"SCANLEX2"
+LEXICON_HEADER = struct.Struct("<8sId")
+LEXICON_OFFSET = struct.Struct("<I")
+LEXICON_KEY = struct.Struct("<H")
+LEXICON_RECORD = struct.Struct("<Bq")
+
+class CompiledLexicon:
+    """Read-only, memory-mapped view of a compiled lexicon file.
+
+    Lookups binary-search the sorted offset table and unpack the
+    matching record straight from the mapped pages, so opening the file
+    costs no more than mapping it, and worker processes share the pages.
+
+    Parameters
+    ----------
+    path : str
+        file written by `manage.py compile_lexicon`
+
+    Attributes
+    ----------
+    count : int
+        number of words in the file
+    compiled_at : float
+        Unix time at which compilation started
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.compiled_at = LEXICON_HEADER.unpack_from(self._map, 0)
+        if magic != LEXICON_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a compiled lexicon file.")
+        self._index = LEXICON_HEADER.size
+        # words whose stats changed after the file was compiled
+        self._stale = set()
+        self._checked = None
+
+    def close(self):
+        """Unmap the file."""
+        self._map.close()
+
+    def get(self, word):
+        """Return (values: list, popularity: int) for word, or None if absent."""
+        key = word.encode("utf-8")
+        data = self._map
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = LEXICON_OFFSET.unpack_from(data, self._index + mid * LEXICON_OFFSET.size)[0]
+            length = LEXICON_KEY.unpack_from(data, offset)[0]
+            offset += LEXICON_KEY.size
+            candidate = data[offset:offset + length]
+            if candidate < key:
+                lo = mid + 1
+            elif candidate > key:
+                hi = mid
+            else:
+                offset += length
+                count, popularity = LEXICON_RECORD.unpack_from(data, offset)
+                values = list(struct.unpack_from(f"<{count}d", data, offset + LEXICON_RECORD.size))
+                return (values, popularity)
+        return None
+
+    def mark_stale(self, words):
+        """Stop answering for words whose stats have changed since compiling."""
+        self._stale.update(words)
+
+    def refresh_stale(self):
+        """Pick up words other processes have changed since the last check.
+
+        Checks WordStats for rows updated since the file was compiled, at
+        most once every SCAN_LEXICON_STALE_CHECK seconds.
+        """
+        now = time.time()
+        interval = getattr(settings, "SCAN_LEXICON_STALE_CHECK", 30)
+        if self._checked is not None and now - self._checked < interval:
+            return
+        # overlap the previous check a little so rows committed just after
+        # their timestamp was taken are not missed
+        since = self.compiled_at if self._checked is None else self._checked - interval
+        self._checked = now
+        updated = WordStats.objects.filter(
+            updated__gt=datetime.fromtimestamp(since, dt_timezone.utc))
+        changed = set(updated.values_list("word", flat=True)) - self._stale
+        if changed:
+            self._stale.update(changed)
+            # scansions cached from the old stats are out of date
+            bump_lexicon_version()
+
+    def lookup(self, word):
+        """Like get, but None for words changed since the file was compiled.
+
+        Also None if the file was unmapped for a recompiled one while the
+        word was being looked up, leaving it to the database.
+        """
+        if word in self._stale:
+            return None
+        try:
+            return self.get(word)
+        except ValueError:
+            return None
+
+# the compiled lexicon currently mapped, if any; see compiled_lexicon
+compiled = None
+compiled_lock = threading.Lock()
+
+def compiled_lexicon():
+    """Return the CompiledLexicon for SCAN_LEXICON_FILE, or None.
+
+    The file is mapped on first use and remapped whenever it is
+    recompiled (unmapping the old one); None is returned if no file has
+    been compiled, or if it is not a lexicon this version can read.
+    """
+    global compiled
+    path = getattr(settings, "SCAN_LEXICON_FILE", None)
+    if not path:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with compiled_lock:
+        if compiled is None or compiled.path != path or compiled.mtime != mtime:
+            previous = compiled
+            try:
+                compiled = CompiledLexicon(path)
+            except ValueError:
+                compiled = None
+            if previous is not None:
+                try:
+                    previous.close()
+                # a lookup on another thread still holds the pages; they
+                # are unmapped when the object is garbage collected
+                except BufferError:
+                    pass
+        return compiled
+
+def normalize(word):
+    """Strip non-alphabetic characters from word and lowercase it.
+
+    Parameters
+    ----------
+    word : str
+        word as it appears in the poem
+
+    Returns
+    -------
+    normalized : str
+        form of the word used as a key in the Pronunciation table
+    """
+    return re.sub(disallowed, "", word).lower()
+
+class Token:
+    """One word of a poem, normalized once when the poem is tokenized.
+
+    Attributes
+    ----------
+    text : str
+        word as it appears in the poem, punctuation included
+    norm : str
+        normalized form used to look the word up (see `normalize`)
+    line : int
+        index of the line the word is on
+    start, end : int
+        span of the word in the poem string
+    """
+    __slots__ = ("text", "norm", "line", "start", "end")
+
+    def __init__(self, text, norm, line, start, end):
+        self.text = text
+        self.norm = norm
+        self.line = line
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"Token({self.text!r}, {self.norm!r}, {self.line}, {self.start}, {self.end})"
+
+@metrics.timed(metrics.stage_seconds, stage="tokenize")
+def tokenize(poem):
+    """Split poem into lines of Tokens.
+
+    Parameters
+    ----------
+    poem : str
+        poem to split
+
+    Returns
+    -------
+    lines : list
+        list of lists of Tokens, one list per line (empty for blank lines)
+    """
+    # offsets of the start of each line in the poem string
+    starts = [0] + [match.end() for match in newline.finditer(poem)]
+    # normalize each distinct spelling only once
+    norms = {}
+    lines = []
+    for index, (start, line) in enumerate(zip(starts, newline.split(poem))):
+        tokens = []
+        cursor = 0
+        for word in line.split():
+            cursor = line.index(word, cursor)
+            norm = norms.get(word)
+            if norm is None:
+                norm = norms[word] = normalize(word)
+            tokens.append(Token(word, norm, index, start + cursor, start + cursor + len(word)))
+            cursor += len(word)
+        lines.append(tokens)
+    return lines
+
+def pattern_stats(patterns):
+    """Calculate stress ratios from all recorded patterns of one word.
+
+    Parameters
+    ----------
+    patterns : list
+        (stresses, popularity) tuples, one for each Pronunciation
+        instance of the word
+
+    Returns
+    -------
+    (values: list, popularity: int) : tuple
+        stress ratio for each syllable of the word, 4 decimal places,
+        and number of times the winning syllable count was scanned
+    """
+    # if there is one, add 0.1 / popularity if it is unstressed or 0.1 * popularity if it is stressed
+    if len(patterns) == 1:
+        stresses, popularity = patterns[0]
+        values = []
+        for char in stresses:
+            if char == "u":
+                values.append(round(0.1 / popularity, 4))
+            else:
+                values.append(2.0 * popularity)
+        return (values, popularity)
+    # some inspiration from https://stackoverflow.com/questions/3844801/check-if-all-elements-in-a-list-are-identical
+    # create a dictionary containing the various syllable counts the word has been judged to have
+    # as keys, and a list of the various stress patterns with that syllable
+    # as the value for each key
+    count_dict = {}
+    for pattern in patterns:
+        count = len(pattern[0])
+        if count in count_dict:
+            count_dict[count].append(pattern)
+        else:
+            count_dict[count] = [pattern]
+    # in order to find the most popular syllable count:
+    # set max, representing the most popular syllable count, equal to 0 initially
+    # and let the highest popularity of any syllable count, max_pop, equal 0 as well
+    max = 0
+    max_pop = 0
+    # loop through count_dict, adding up the popularities of each pattern for a given length,
+    # and making max_pop equal to the maximum sum of popularities thus far
+    for length in count_dict:
+        # https://stackoverflow.com/questions/25047561/finding-a-sum-in-nested-list-using-a-lambda-function
+        popularity = sum(pattern[1] for pattern in count_dict[length])
+        if popularity >= max_pop:
+            max_pop = popularity
+            max = length
+    # having found the most popular syllable count, loop through all stress patterns
+    # with that syllable count for each syllable, finding the sum of popularities
+    # for stressed and unstressed values of that syllable respectively
+    values = []
+    for i in range(max):
+        stressed = 0
+        unstressed = 0.01
+        for stresses, popularity in count_dict[max]:
+            if stresses[i] == "/":
+                stressed += popularity
+            else:
+                unstressed += popularity
+        # add the ratio of stressed to unstressed interpretations of each syllable
+        # to the "values" list in order
+        values.append(round(stressed / unstressed, 4))
+    return (values, max_pop)
+
+def fetch_patterns(words):
+    """Fetch recorded stress patterns of many normalized words.
+
+    Parameters
+    ----------
+    words : list
+        distinct normalized words
+
+    Returns
+    -------
+    patterns : dict
+        maps each word found in Pronunciation to a list of
+        (stresses, popularity) tuples
+    """
+    patterns = {}
+    for i in range(0, len(words), LOOKUP_BATCH_SIZE):
+        # order by word and then pk so patterns are grouped in the same
+        # order a single-word query returns them (and the index can be used)
+        rows = (Pronunciation.objects
+                .filter(word__in=words[i:i + LOOKUP_BATCH_SIZE])
+                .order_by("word", "pk")
+                .values_list("word", "stresses", "popularity"))
+        for word, stresses, popularity in rows:
+            patterns.setdefault(word, []).append((stresses, popularity))
+    return patterns
+
+# ratio given to the syllables an inflectional ending adds to a stem,
+# the same as an unstressed syllable scanned once
+SUFFIX_RATIO = 0.1
+
+# inflectional endings an out-of-lexicon word may be derived with:
+# ending -> (letters it replaces at the end of the stem, syllables added);
+# None for syllables means it depends on the stem (see suffix_syllables)
+SUFFIXES = {
+    "s": ("", None),      # cats, horses
+    "es": ("", None),     # goes, boxes
+    "ies": ("y", 0),      # carries
+    "d": ("", None),      # loved, hated, lov'd
+    "ed": ("", None),     # walked, wanted
+    "ied": ("y", 0),      # carried
+    "ing": ("", 1),       # singing, loving, stopping
+    "r": ("", 1),         # lover
+    "er": ("", 1),        # colder
+    "st": ("", 1),        # wisest, lovest
+    "est": ("", 1),       # coldest
+    "th": ("", 1),        # loveth
+    "eth": ("", 1),       # singeth
+    "ly": ("", 1),        # softly
+    "ily": ("y", 1),      # happily
+    "ness": ("", 1),      # darkness
+    "iness": ("y", 1),    # happiness
+    "less": ("", 1),      # heartless
+    "ful": ("", 1),       # fearful
+    "ment": ("", 1),      # amazement
+}
+# endings that only follow a stem's silent e
+E_SUFFIXES = {"d", "r", "st", "th"}
+
+def build_suffix_trie(suffixes):
+    """Build a trie of the reversed endings in suffixes.
+
+    Each node is a dict from letter to child node; the node reached by an
+    ending's last letter has the ending itself under the key None.
+    """
+    trie = {}
+    for suffix in suffixes:
+        node = trie
+        for letter in reversed(suffix):
+            node = node.setdefault(letter, {})
+        node[None] = suffix
+    return trie
+
+suffix_trie = build_suffix_trie(SUFFIXES)
+
+# the set of words with a Pronunciation, loaded the first time a word is
+# missing from the lexicon (see known_words)
+stem_index = None
+stem_lock = threading.Lock()
+# how each out-of-lexicon word derives from a stem: (stem, syllables added)
+stem_cache = LRUCache(getattr(settings, "SCAN_STATS_CACHE_SIZE", 10000))
+
+def known_words():
+    """Return the set of words that have a Pronunciation."""
+    global stem_index
+    with stem_lock:
+        if stem_index is None:
+            stem_index = set(Pronunciation.objects.values_list("word", flat=True).distinct())
+        return stem_index
+
+def learn_words(words):
+    """Add newly known words to the stem index.
+
+    Words cached as unknown may derive from a word that is new to the
+    index, so they are dropped from `stats_cache` if there is one.
+    """
+    with stem_lock:
+        if stem_index is None:
+            return
+        new = set(words) - stem_index
+        stem_index.update(new)
+    if new:
+        stats_cache.invalidate_where(lambda value: value[1] == 0 and "?" in value[0])
+
+def suffix_syllables(suffix, stem):
+    """Return the number of syllables suffix adds to stem."""
+    syllable_count = SUFFIXES[suffix][1]
+    if syllable_count is not None:
+        return syllable_count
+    if suffix == "s":
+        # horses, places, ages, but not loves
+        return int(stem.endswith(("se", "ze", "ce", "ge", "xe", "che", "she")))
+    if suffix == "es":
+        # boxes, churches, but not goes
+        return int(stem.endswith(("s", "x", "z", "ch", "sh")))
+    if suffix == "ed":
+        # wanted, added, but not walked
+        return int(stem.endswith(("t", "d")))
+    # "d" after a silent e: hated, faded, but not loved
+    return int(stem.endswith(("te", "de")))
+
+def candidate_stems(word):
+    """Yield (ending, stem) pairs word could be inflected from.
+
+    The word is walked backwards through `suffix_trie` once, finding
+    every ending it has from shortest to longest, so longer stems come
+    first. Stems may get a silent e back (loving), lose a doubled
+    consonant (stopping) or turn i into y (carried); whether they are
+    words at all is not checked.
+    """
+    node = suffix_trie
+    # stems shorter than three letters give too many false matches
+    for i in range(len(word) - 1, 2, -1):
+        node = node.get(word[i])
+        if node is None:
+            return
+        suffix = node.get(None)
+        if suffix is None:
+            continue
+        base = word[:i]
+        restore = SUFFIXES[suffix][0]
+        if restore:
+            candidates = [base + restore]
+        elif suffix in E_SUFFIXES:
+            candidates = [base] if base.endswith("e") else []
+            if suffix == "d":
+                # lov'd
+                candidates.append(base + "e")
+        else:
+            candidates = [base + "e", base]
+            # doubled consonant
+            if len(base) > 2 and base[-1] == base[-2] and base[-1] not in "aeiouyls":
+                candidates.append(base[:-1])
+        for stem in candidates:
+            if stem != word:
+                yield suffix, stem
+
+def derive_stems(words):
+    """Find the longest known stem of each out-of-lexicon word.
+
+    The first of a word's `candidate_stems` found in `known_words` is
+    its longest known stem.
+
+    Parameters
+    ----------
+    words : iterable
+        normalized words missing from the lexicon
+
+    Returns
+    -------
+    stems : dict
+        maps each word that has a known stem to a (stem: str,
+        syllables added: int) tuple
+    """
+    known = known_words()
+    stems = {}
+    for word in words:
+        for suffix, stem in candidate_stems(word):
+            if stem in known:
+                stems[word] = (stem, suffix_syllables(suffix, stem))
+                break
+    return stems
+
+@metrics.timed(metrics.stage_seconds, stage="lookup")
+def lexicon_stats(words):
+    """Look up stress ratios for many normalized words at once.
+
+    Words are served from `stats_cache` when possible, then from the
+    memory-mapped compiled lexicon (unless they changed after it was
+    compiled), then from the precomputed WordStats table; only words
+    missing from all of those have their Pronunciation instances
+    aggregated. Each step is a single
+    `word__in` query (batched for very long poems) instead of one
+    query per word. Words that are still unknown are derived from their
+    longest known stem when they have one (see `derive_stems`), and only
+    get a syllable count guess otherwise.
+
+    Parameters
+    ----------
+    words : iterable
+        normalized words (see `normalize`); duplicates are fine
+
+    Returns
+    -------
+    stats : dict
+        maps each word to a (values: list, popularity: int) tuple as
+        returned by `get_stats(word, confidence=True)`
+    """
+    stats = {}
+    # serve what we can from the cache; values are cached as tuples so
+    # callers cannot modify cached entries through the lists they get back
+    missing = []
+    derived = {}
+    for word in set(words):
+        cached = stats_cache.get(word)
+        if cached is not None:
+            stats[word] = (list(cached[0]), cached[1])
+            continue
+        # derived words are not cached themselves, so they follow their
+        # stem's stats, but how they derive from it is
+        stem = stem_cache.get(word)
+        if stem is None:
+            missing.append(word)
+        else:
+            derived[word] = stem
+    # then try the compiled lexicon file, if there is one
+    reader = compiled_lexicon()
+    if reader is not None and missing:
+        reader.refresh_stale()
+        for word in missing:
+            found = reader.lookup(word)
+            if found is not None:
+                stats[word] = found
+        missing_db = [word for word in missing if word not in stats]
+    else:
+        missing_db = missing
+    # then read precomputed ratios for the rest
+    for i in range(0, len(missing_db), LOOKUP_BATCH_SIZE):
+        rows = (WordStats.objects
+                .filter(word__in=missing_db[i:i + LOOKUP_BATCH_SIZE])
+                .values_list("word", "ratios", "popularity"))
+        for word, ratios, popularity in rows:
+            stats[word] = (ratios, popularity)
+    # and fall back to aggregating Pronunciation for words not yet in WordStats
+    words = [word for word in missing if word not in stats]
+    patterns = fetch_patterns(words) if words else {}
+    unknown = []
+    for word in words:
+        if word in patterns:
+            stats[word] = pattern_stats(patterns[word])
+        else:
+            unknown.append(word)
+    # derive inflected words from their stems
+    if unknown and getattr(settings, "SCAN_STEM_FALLBACK", True):
+        for word, stem in derive_stems(unknown).items():
+            derived[word] = stem
+            stem_cache.set(word, stem)
+        unknown = [word for word in unknown if word not in derived]
+    # if there are none, guess the syllable count and return a list of
+    # [syllables] question marks to indicate that stress pattern is unknown
+    for word, count in zip(unknown, syllables_many(unknown)):
+        stats[word] = (["?" for i in range(count)], 0)
+    for word in missing:
+        if word not in derived:
+            stats_cache.set(word, (tuple(stats[word][0]), stats[word][1]))
+    # a derived word has its stem's ratios plus unstressed added syllables
+    if derived:
+        stem_stats = lexicon_stats({stem for stem, added in derived.values()})
+        for word, (stem, added) in derived.items():
+            values, popularity = stem_stats[stem]
+            stats[word] = (list(values) + [SUFFIX_RATIO] * added, popularity)
+    return stats
+
+def refresh_word_stats(words, generation=None):
+    """Recompute the WordStats rows of words from Pronunciation.
+
+    Parameters
+    ----------
+    words : iterable
+        normalized words whose Pronunciation instances changed
+
+    generation : int, optional
+        lexicon generation to stamp on the rows (see `bump_generation`)
+    """
+    words = list(set(words))
+    patterns = fetch_patterns(words)
+    existing = {}
+    for i in range(0, len(words), LOOKUP_BATCH_SIZE):
+        existing.update((ws.word, ws) for ws in
+                        WordStats.objects.filter(word__in=words[i:i + LOOKUP_BATCH_SIZE]))
+    to_create = []
+    to_update = []
+    kept = set()
+    for word, word_patterns in patterns.items():
+        try:
+            values, popularity = pattern_stats(word_patterns)
+        # a lone pattern with popularity 0 has no ratio; leave it to get_stats
+        except ZeroDivisionError:
+            continue
+        if word in existing:
+            ws = existing[word]
+            # leave rows whose stats did not change alone, keeping the
+            # timestamp the compiled lexicon checks and their generation
+            if (ws.ratios, ws.popularity, ws.syllables) == (values, popularity, len(values)):
+                kept.add(word)
+                continue
+            ws.syllables = len(values)
+            ws.ratios = values
+            ws.popularity = popularity
+            ws.updated = timezone.now()
+            if generation is not None:
+                ws.generation = generation
+            to_update.append(ws)
+        else:
+            to_create.append(WordStats(word=word, syllables=len(values),
+                                       ratios=values, popularity=popularity,
+                                       generation=generation or 0))
+    WordStats.objects.bulk_update(to_update, ["syllables", "ratios", "popularity",
+                                              "updated", "generation"],
+                                  batch_size=LOOKUP_BATCH_SIZE)
+    WordStats.objects.bulk_create(to_create, batch_size=LOOKUP_BATCH_SIZE)
+    # words whose patterns were all removed go back to being unknown
+    kept.update(ws.word for ws in to_update)
+    gone = [word for word in existing if word not in kept]
+    for i in range(0, len(gone), LOOKUP_BATCH_SIZE):
+        WordStats.objects.filter(word__in=gone[i:i + LOOKUP_BATCH_SIZE]).delete()
+    # the compiled lexicon file no longer has the right stats for these words
+    reader = compiled_lexicon()
+    if reader is not None:
+        reader.mark_stale(words)
+
+def bump_lexicon_version():
+    """Mark every cached scansion as out of date."""
+    global lexicon_version
+    lexicon_version += 1
+
+def bump_generation():
+    """Increment the database lexicon generation and return the new one.
+
+    Call inside the transaction that changes the patterns, so that the
+    increment and the changes commit together.
+    """
+    state = LexiconState.objects.filter(pk=1)
+    if not state.update(generation=F("generation") + 1):
+        # the row does not exist yet; create it (or let a concurrent
+        # creator win) and increment it
+        LexiconState.objects.bulk_create([LexiconState(pk=1)], ignore_conflicts=True)
+        state.update(generation=F("generation") + 1)
+    return state.values_list("generation", flat=True).get()
+
+def lexicon_generation():
+    """Return the current database lexicon generation (0 if never bumped)."""
+    return LexiconState.objects.filter(pk=1).values_list("generation", flat=True).first() or 0
+
+def sync_lexicon():
+    """Bring this process's caches up to date with the database lexicon.
+
+    Stats cached for words that other processes changed since the last
+    sync are dropped (on the first sync, everything cached is), and
+    cached scansions are marked out of date if anything changed.
+
+    Returns
+    -------
+    generation : int
+        the current lexicon generation
+    """
+    global synced_generation
+    generation = lexicon_generation()
+    if synced_generation is None:
+        stats_cache.clear()
+        stem_cache.clear()
+        bump_lexicon_version()
+    elif generation > synced_generation:
+        changed = list(WordStats.objects.filter(generation__gt=synced_generation)
+                       .values_list("word", flat=True))
+        for word in changed:
+            stats_cache.invalidate(word)
+            stem_cache.invalidate(word)
+        learn_words(changed)
+        bump_lexicon_version()
+    synced_generation = generation
+    return generation
+
+def words_generation(words):
+    """Return the latest generation in which any of words changed.
+
+    Words missing from the lexicon count as changed when the stem they
+    derive from did (see `derive_stems`).
+
+    Parameters
+    ----------
+    words : iterable
+        normalized words
+
+    Returns
+    -------
+    generation : int
+        0 if none of the words changed since generations were introduced
+    """
+    words = set(words)
+    if getattr(settings, "SCAN_STEM_FALLBACK", True):
+        known = known_words()
+        stems = derive_stems([word for word in words if word not in known])
+        words.update(stem for stem, added in stems.values())
+    words = list(words)
+    latest = 0
+    for i in range(0, len(words), LOOKUP_BATCH_SIZE):
+        batch = (WordStats.objects.filter(word__in=words[i:i + LOOKUP_BATCH_SIZE])
+                 .aggregate(latest=Max("generation")))
+        latest = max(latest, batch["latest"] or 0)
+    return latest
+
+def stale_scansions(poem, scansions, generation, force=False):
+    """Return the stored scansions of poem that the lexicon has outdated.
+
+    These are the scansions behind `generation` scanned before a word
+    of the poem last changed (or all of those behind it, if force).
+    Takes one query if any scansion is behind, and none otherwise.
+    """
+    behind = [s for s in scansions if s.generation < generation]
+    if force or not behind:
+        return behind
+    latest = words_generation(token.norm for tokens in tokenize(poem) for token in tokens)
+    return [s for s in behind if s.generation < latest]
+
+def refresh_scansions(poem, scansions, generation, force=False, results=None):
+    """Rescan the stored scansions of poem that the lexicon has outdated.
+
+    Scansions behind `generation` are rescanned only if a word of the
+    poem changed after the generation they were scanned at (see
+    `stale_scansions`); the others are just marked up to date. Either
+    way, the rows are saved in one query.
+
+    Parameters
+    ----------
+    poem : str
+        text of the poem the scansions belong to
+
+    scansions : iterable
+        PoemScansion instances of the poem, with `type` loaded; the stale
+        ones are updated in place
+
+    generation : int
+        current lexicon generation (see `sync_lexicon`)
+
+    force : bool, default: False
+        rescan every scansion behind `generation`, changed words or not
+
+    results : dict, optional
+        scansions of poem by algorithm name already computed against the
+        current lexicon (say, on another thread); only algorithms missing
+        from it are run
+
+    Returns
+    -------
+    rescanned : list
+        the PoemScansion instances whose scansion was recomputed
+    """
+    behind = [s for s in scansions if s.generation < generation]
+    if not behind:
+        return []
+    stale = stale_scansions(poem, behind, generation, force)
+    results = dict(results or {})
+    results.update(scan_all(poem, sorted({s.type.function_name for s in stale} - set(results))))
+    for s in stale:
+        s.scansion = results[s.type.function_name]
+    for s in behind:
+        s.generation = generation
+    PoemScansion.objects.bulk_update(behind, ["scansion", "generation"])
+    return stale
+
+def poem_words(poem):
+    """Return the words a poem is indexed under in WordOccurrence.
+
+    These are the poem's normalized words and every stem they could be
+    inflected from, so that a change to "moon" finds poems with "moons"
+    even before "moons" is known to derive from it.
+
+    Parameters
+    ----------
+    poem : str
+        text of the poem
+
+    Returns
+    -------
+    words : set
+        words short enough to be in the lexicon
+    """
+    max_length = WordOccurrence._meta.get_field("word").max_length
+    words = set()
+    for tokens in tokenize(poem):
+        for token in tokens:
+            if token.norm and token.norm not in words:
+                words.add(token.norm)
+                words.update(stem for suffix, stem in candidate_stems(token.norm))
+    return {word for word in words if len(word) <= max_length}
+
+def index_poem(poem):
+    """Bring the WordOccurrence rows of a saved Poem up to date with its text.
+
+    Costs a single query if the words did not change.
+    """
+    words = poem_words(poem.poem)
+    existing = set(WordOccurrence.objects.filter(poem=poem).values_list("word", flat=True))
+    if words == existing:
+        return
+    removed = list(existing - words)
+    with transaction.atomic():
+        for i in range(0, len(removed), LOOKUP_BATCH_SIZE):
+            WordOccurrence.objects.filter(poem=poem, word__in=removed[i:i + LOOKUP_BATCH_SIZE]).delete()
+        WordOccurrence.objects.bulk_create(
+            [WordOccurrence(word=word, poem=poem) for word in words - existing],
+            batch_size=LOOKUP_BATCH_SIZE, ignore_conflicts=True)
+
+def changed_poem_ids(since, until):
+    """Return ids of poems with words changed in generations (since, until].
+
+    Poems with no WordOccurrence rows at all (such as poems loaded from a
+    fixture and not indexed since) are included, since which of their
+    words changed cannot be told.
+
+    Parameters
+    ----------
+    since, until : int
+        lexicon generations
+
+    Returns
+    -------
+    poem_ids : QuerySet
+        a subquery of poem ids, through WordOccurrence
+    """
+    changed = (WordStats.objects.filter(generation__gt=since, generation__lte=until)
+               .values("word"))
+    occurrences = WordOccurrence.objects.filter(poem=OuterRef("pk"))
+    return (Poem.objects.filter(Q(Exists(occurrences.filter(word__in=changed)))
+                                | ~Q(Exists(occurrences)))
+            .values_list("pk", flat=True))
+
+def poem_key(lines):
+    """Hash the normalized words of a tokenized poem, line by line.
+
+    Poems that differ only in capitalization, punctuation or spacing get
+    the same key, since they scan the same.
+
+    Parameters
+    ----------
+    lines : list
+        tokenize(poem)
+
+    Returns
+    -------
+    key : bytes
+        16-byte BLAKE2b digest
+    """
+    text = "\n".join(" ".join(token.norm for token in tokens) for tokens in lines)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def clear_caches():
+    """Empty the word stats and scansion caches and the stem index.
+
+    Needed when the database changes behind the module's back, such as
+    between tests.
+    """
+    global stem_index, synced_generation
+    synced_generation = None
+    stats_cache.clear()
+    stem_cache.clear()
+    scansion_cache.clear()
+    with stem_lock:
+        stem_index = None
+
+def stats_cache_info():
+    """Report hit, miss and size counters of the word stats cache.
+
+    Returns
+    -------
+    info : dict
+        `hits`, `misses`, `size` and `maxsize` of `stats_cache`
+    """
+    return stats_cache.info()
 
 def get_stats(word, confidence=False):
     """Get ratio of stressed scansions to unstressed for word's syllables.
@@ -43,73 +1030,13 @@ def get_stats(word, confidence=False):
         values as above and number of times word was scanned
     """
     # get version of word without non-alphabetic characters and lowercase
-    w = re.sub(disallowed, "", word)
-    w_lower = w.lower()
-    # get all pronunciations of the word
-    patterns = Pronunciation.objects.filter(word=w_lower)
-    # if there are none, guess the syllable count and return a list of
-    # [syllables] question marks to indicate that stress pattern is unknown
-    if not patterns.exists():
-        scansion = ["?" for i in range(syllables(w))]
-        if confidence:
-            return (scansion, 0)
-        return scansion
-    # if there is one, add 0.1 / popularity if it is unstressed or 0.1 * popularity if it is stressed
-    elif patterns.count() == 1:
-        values = []
-        for char in patterns[0].stresses:
-            if char == "u":
-                values.append(round(0.1 / patterns[0].popularity, 4))
-            else:
-                values.append(2.0 * patterns[0].popularity)
-        if confidence:
-            return (values, patterns[0].popularity)
-        return values
-    else:
-        # some inspiration from https://stackoverflow.com/questions/3844801/check-if-all-elements-in-a-list-are-identical
-        # create a dictionary containing the various syllable counts the word has been judged to have
-        # as keys, and a list of the various stress patterns with that syllable
-        # as the value for each key
-        count_dict = {}
-        for pattern in patterns:
-            count = len(pattern.stresses)
-            if count in count_dict:
-                count_dict[count].append(pattern)
-            else:
-                count_dict[count] = [pattern]
-        # in order to find the most popular syllable count:
-        # set max, representing the most popular syllable count, equal to 0 initially
-        # and let the highest popularity of any syllable count, max_pop, equal 0 as well
-        max = 0
-        max_pop = 0
-        # loop through count_dict, adding up the popularities of each pattern for a given length,
-        # and making max_pop equal to the maximum sum of popularities thus far
-        for length in count_dict:
-            # https://stackoverflow.com/questions/25047561/finding-a-sum-in-nested-list-using-a-lambda-function
-            popularity = sum(pattern.popularity for pattern in count_dict[length])
-            if popularity >= max_pop:
-                max_pop = popularity
-                max = length
-        # having found the most popular syllable count, loop through all stress patterns
-        # with that syllable count for each syllable, finding the sum of popularities
-        # for stressed and unstressed values of that syllable respectively
-        values = []
-        for i in range(max):
-            stressed = 0
-            unstressed = 0.01
-            for pattern in count_dict[max]:
-                if pattern.stresses[i] == "/":
-                    stressed += pattern.popularity
-                else:
-                    unstressed += pattern.popularity
-            # add the ratio of stressed to unstressed interpretations of each syllable
-            # to the "values" list in order
-            values.append(round(stressed / unstressed, 4))
-        if confidence:
-            return (values, max_pop)
-        return values
-
-def poem_stats(poem, confidence=False):
+    w = normalize(word)
+    values, popularity = lexicon_stats([w])[w]
+    if confidence:
+        return (values, popularity)
+    return values
+
+def poem_stats(poem, confidence=False, lines=None, lexicon=None):
     """Find stress ratio for each word in a poem.
 
     Parameters
@@ -120,33 +1047,53 @@ def poem_stats(poem, confidence=False):
     confidence : boolean
         whether to return # of times words were scanned
 
+    lines : list, optional
+        tokenize(poem), if the poem has already been tokenized
+
+    lexicon : dict, optional
+        lexicon_stats output covering every word of the poem; if given,
+        the database is not queried at all
+
     Returns
     -------
     stress_list : list
         list of lists of stress ratios
     """
-    # split poem into lines
-    lines = newline.split(poem)
+    if lines is None:
+        lines = tokenize(poem)
+    # look up every distinct word in the poem at once
+    if lexicon is None:
+        stats = lexicon_stats(token.norm for tokens in lines for token in tokens)
+    else:
+        stats = lexicon
     stress_list = []
+    words = unknown = syllable_count = 0
     # for each line get the stress probability (stressed / unstressed)
     # for each word and append it to stress list; for spaces, append a space
-    for line in lines:
-        words = line.split()
+    for tokens in lines:
         line_list = []
-        for word in words:
-            stress = get_stats(word)
-            line_list.extend(stress)
+        for token in tokens:
+            values = stats[token.norm][0]
+            line_list.extend(values)
             line_list.append(" ")
+            words += 1
+            syllable_count += len(values)
+            if values and values[0] == "?":
+                unknown += 1
         stress_list.append(line_list)
+    metrics.record_scan(words, unknown, syllable_count)
     return stress_list
 
-def original_scan(poem):
+def original_scan(poem, stress_list=None):
     """Scan poem by comparing each stress ratio to the next.
     
     Parameters
     ----------
     poem : str
         poem to scan
+
+    stress_list : list, optional
+        poem_stats(poem), if it has already been computed
         
     Return
     ------
@@ -155,7 +1102,8 @@ def original_scan(poem):
     """
     # get stress ratio for each syllble in each word, separated by spaces,
     # and organized into lines
-    stress_list = poem_stats(poem)
+    if stress_list is None:
+        stress_list = poem_stats(poem)
     poem_scansion = []
     # for each line in this, compare the stress ratio for each word to the next
     for line in stress_list:
@@ -222,13 +1170,70 @@ def original_scan(poem):
     return "\n".join(poem_scansion)
 
 # see https://leetcode.com/problems/house-robber/discuss/156523/From-good-to-great.-How-to-approach-most-of-DP-problems.
-def house_robber_scan(poem):
+def house_robber_line(line):
+    """Scan one line of stress ratios with the house robber DP.
+
+    Runs in linear time: instead of copying the candidate stress lists
+    and re-summing them at every syllable, each candidate is kept as a
+    running total plus a backpointer chain of stressed indices.
+
+    Parameters
+    ----------
+    line : list
+        stress ratios of one line as returned by `poem_stats`
+
+    Returns
+    -------
+    line_scansion : str
+        scansion of the line with words separated by spaces
+    """
+    # prev1 and prev2 are the best (sum, chain) for the syllables up to the
+    # previous one and the one before that; a chain is a linked list of
+    # (index, rest) pairs so extending it does not copy anything
+    prev1 = (0, None)
+    prev2 = (0, None)
+    for i, value in enumerate(line):
+        # skip spaces and guess 0.3 for question marks
+        if value == " ":
+            continue
+        if value == "?":
+            value = 0.3
+        # if stressing this syllable on top of prev2 is at least as good as
+        # prev1, that becomes the new prev1; either way, the old prev1 becomes
+        # prev2 (sums are accumulated in the same order as before, so ties
+        # resolve exactly as they always have)
+        tmp = prev1
+        if prev1[0] <= prev2[0] + value:
+            prev1 = (prev2[0] + value, (i, prev2[1]))
+        prev2 = tmp
+    # walk the winning chain to collect the stressed indices
+    stressed = set()
+    chain = prev1[1]
+    while chain is not None:
+        stressed.add(chain[0])
+        chain = chain[1]
+    # carry spaces over into the scansion untouched, and mark indices in
+    # the winning chain stressed and everything else unstressed
+    symbols = []
+    for i, value in enumerate(line):
+        if value == " ":
+            symbols.append(" ")
+        elif i in stressed:
+            symbols.append("/")
+        else:
+            symbols.append("u")
+    return "".join(symbols)
+
+def house_robber_scan(poem, stress_list=None):
     """Scan poem by finding max sum of ratios with no adjacent stresses
     
     Parameters
     ----------
     poem : str
         poem to scan
+
+    stress_list : list, optional
+        poem_stats(poem), if it has already been computed
     
     Returns
     -------
@@ -236,65 +1241,30 @@ def house_robber_scan(poem):
         scansion with lines separated by newlines, words by spaces        
     """
     # get stress pattern of poem
-    stress_list = poem_stats(poem)
-    poem_scansion = []
-    for line in stress_list:
-        # remove spaces and replace question marks with a guess of 0.3
-        # add each value to a tuple containing its index as the second value
-        spaceless_line = []
-        for i, value in enumerate(line):
-            if value != " ":
-                if value == "?":
-                    spaceless_line.append((0.3, i))
-                else:
-                    spaceless_line.append((value, i))
-        # initialize two lists to represent potential stress patterns for the lines
-        prev1 = []
-        prev2 = []
-        # iterate through spaceless line so constructed
-        for pair in spaceless_line:
-            tmp = copy(prev1)
-            # https://stackoverflow.com/questions/25047561/finding-a-sum-in-nested-list-using-a-lambda-function
-            # if the sum of stress values contained in prev1 is less than the sum
-            # of stress values in prev2 + the current stress value
-            # make prev1 a copy of prev2
-            if sum(p[0] for p in prev1) <= sum(p[0] for p in prev2) + pair[0]:
-                prev2.append(pair)
-                prev1 = copy(prev2)
-            # either way, make the previous prev1 prev2
-            prev2 = copy(tmp)
-        # iterate through original line, adding to a scansion
-        line_scansion = ""
-        for i, value in enumerate(line):
-            # carry spaces over into the scansion untouched
-            if value == " ":
-                line_scansion += value
-            # otherwise, if a given value is an index included in prev1,
-            # which is the "winner" for highest values
-            # make it stressed, and if it is not, make it unstressed
-            elif [pair for pair in prev1 if pair[1] == i]:
-                line_scansion += "/"
-            else:
-                line_scansion += "u"
-        poem_scansion.append(line_scansion)
-    return "\n".join(poem_scansion)
+    if stress_list is None:
+        stress_list = poem_stats(poem)
+    return "\n".join(house_robber_line(line) for line in stress_list)
 
-def prose_scan(poem):
+def prose_scan(poem, stress_list=None):
     """Scan poem using ratios but not comparing them
     
     Parameters
     ----------
     poem : str
         poem to scan
+
+    stress_list : list, optional
+        poem_stats(poem), if it has already been computed
     
     Returns
     -------
     scansion : str
         scansion with lines separated by newlines, words by spaces
     """
-    stats = poem_stats(poem)
+    if stress_list is None:
+        stress_list = poem_stats(poem)
     poem_scansion = []
-    for line in stats:
+    for line in stress_list:
         line_scansion = ""
         if line:
             for value in line:
@@ -307,9 +1277,165 @@ def prose_scan(poem):
         poem_scansion.append(line_scansion)
     return "\n".join(poem_scansion)
 
+# scansion algorithms by the function_name of their Algorithm instance
+SCANS = {"house_robber_scan": house_robber_scan, "original_scan": original_scan, "prose_scan": prose_scan}
+# use the NumPy versions of the comparison-free scans if asked to and available
+if getattr(settings, "SCAN_VECTORIZED", False) and vectorized.np is not None:
+    SCANS["original_scan"] = vectorized.original_scan
+    SCANS["prose_scan"] = vectorized.prose_scan
+
+def scan_all(poem, names, lexicon=None):
+    """Scan poem with several algorithms off one stats computation.
+
+    Scansions are served from `scansion_cache` when the same normalized
+    text was scanned with the same algorithm since the lexicon last
+    changed (see `poem_key` and `bump_lexicon_version`).
+
+    Parameters
+    ----------
+    poem : str
+        poem to scan
+
+    names : list
+        keys of SCANS (Algorithm function_names) to run
+
+    lexicon : dict, optional
+        lexicon_stats output covering every word of the poem, to scan
+        without querying the database
+
+    Returns
+    -------
+    scansions : dict
+        maps each name to its algorithm's scansion of the poem
+    """
+    if not names:
+        return {}
+    lines = tokenize(poem)
+    key = poem_key(lines)
+    # read the version once, before scanning: cached scansions are looked up
+    # under it, and new ones are only cached under it if it did not change
+    # while they were computed (they may be out of date for the new one)
+    version = lexicon_version
+    scansions = {}
+    for name in names:
+        cached = scansion_cache.get((key, name, version))
+        if cached is not None:
+            scansions[name] = cached
+    todo = [name for name in names if name not in scansions]
+    if todo:
+        # look up the poem once for every algorithm not cached
+        stress_list = poem_stats(poem, lines=lines, lexicon=lexicon)
+        for name in todo:
+            with metrics.timed(metrics.algorithm_seconds, algorithm=name):
+                scansions[name] = SCANS[name](poem, stress_list=stress_list)
+            if lexicon_version == version:
+                scansion_cache.set((key, name, version), scansions[name])
+    return {name: scansions[name] for name in names}
+
+def add_popularities(increments, create_only=False):
+    """Add to the popularity of many stress patterns at once.
+
+    All writes happen in one transaction with a fixed number of queries
+    however many patterns there are. Popularities are incremented with
+    F() expressions, and the unique constraint on (word, stresses)
+    turns a concurrent insert of the same new pattern into a no-op, so
+    simultaneous writers never lose counts. The lexicon generation is
+    bumped in the same transaction, so stored PoemScansions of poems
+    with the changed words can be found to be stale (see
+    `refresh_scansions`).
+
+    Parameters
+    ----------
+    increments : dict
+        maps (word, stresses) tuples of normalized words to the number
+        to add to that pattern's popularity
+
+    create_only : bool, default: False
+        only create missing patterns (with the given popularity) and
+        leave patterns that already exist untouched
+    """
+    if not increments:
+        return
+    words = list({word for word, stresses in increments})
+    with transaction.atomic():
+        if create_only:
+            Pronunciation.objects.bulk_create(
+                [Pronunciation(word=word, stresses=stresses, popularity=count)
+                 for (word, stresses), count in increments.items()],
+                ignore_conflicts=True)
+        else:
+            # create any pattern that is not there yet with a popularity of 0
+            # (patterns that already exist, even if another submission just
+            # created them, are skipped thanks to the unique constraint)
+            Pronunciation.objects.bulk_create(
+                [Pronunciation(word=word, stresses=stresses, popularity=0)
+                 for word, stresses in increments],
+                ignore_conflicts=True)
+            # then increment the popularity of every pattern, in the
+            # database, by the number of times it was scanned
+            to_update = []
+            for i in range(0, len(words), LOOKUP_BATCH_SIZE):
+                for pron in Pronunciation.objects.filter(word__in=words[i:i + LOOKUP_BATCH_SIZE]):
+                    count = increments.get((pron.word, pron.stresses))
+                    if count:
+                        pron.popularity = F("popularity") + count
+                        to_update.append(pron)
+            Pronunciation.objects.bulk_update(to_update, ["popularity"], batch_size=LOOKUP_BATCH_SIZE)
+        # bring the precomputed ratios of every word changed up to date,
+        # stamped with a new lexicon generation
+        generation = bump_generation()
+        refresh_word_stats(words, generation)
+    # and drop cached stats and scansions that no longer match the database
+    forget_words(words, generation)
+
+def forget_words(words, generation):
+    """Drop what this process cached about words changed in generation.
+
+    Parameters
+    ----------
+    words : iterable
+        normalized words whose Pronunciation instances changed
+
+    generation : int
+        lexicon generation the change was stamped with
+    """
+    global synced_generation
+    words = list(words)
+    if synced_generation == generation - 1:
+        # nothing else changed since the caches were last synced
+        synced_generation = generation
+    bump_lexicon_version()
+    for word in words:
+        stats_cache.invalidate(word)
+        stem_cache.invalidate(word)
+    # the words are known now, so they can be stems of others
+    learn_words(words)
+
+def pronunciations_changed(words):
+    """Bring WordStats and the caches up to date with edited patterns.
+
+    For Pronunciation instances saved or deleted one at a time, as in
+    the admin. The caches are dropped once the transaction commits.
+
+    Parameters
+    ----------
+    words : iterable
+        normalized words whose Pronunciation instances changed
+    """
+    words = list(set(words))
+    if not words:
+        return
+    with transaction.atomic():
+        generation = bump_generation()
+        refresh_word_stats(words, generation)
+    transaction.on_commit(lambda: forget_words(words, generation))
+
 # record stress patterns of words scanned by a promoted user in the database
 def record(poem, scansion):
     """Record user scansions of individual words in database
+
+    See `add_popularities`, which makes the writes atomic and safe
+    against concurrent submissions.
     
     Parameters
     ----------
@@ -319,24 +1445,11 @@ def record(poem, scansion):
         scansion as string separated with spaces and newlines
     """
     # split both poem and scansion on spaces
-    words = poem.split()
-    cleaned_words = [re.sub(disallowed, "", word).lower() for word in words]
+    cleaned_words = [token.norm for tokens in tokenize(poem) for token in tokens]
     scanned_words = scansion.split()
-    # find each word in the database if it is there
-    for i, word in enumerate(cleaned_words):
-        w = Pronunciation.objects.filter(word=word)
-        # see if any instances of the word have the user-inputted stress pattern
-        found = False
-        for pron in w:
-            # increment the popularity of that stress pattern if it is found
-            if scanned_words[i] == pron.stresses:
-                pron.popularity += 1
-                pron.save()
-                found = True
-        # otherwise create a new instance of the word with the correct pronunciation
-        if not found:
-            new_pron = Pronunciation(word=word, stresses=scanned_words[i], popularity=1)
-            new_pron.save()
+    # count how many times each word was scanned with each stress pattern
+    increments = Counter((word, scanned_words[i]) for i, word in enumerate(cleaned_words))
+    add_popularities(increments)
 
 # count the syllables in a word if it is not in the database
 def syllables(word):
@@ -356,20 +1469,60 @@ def syllables(word):
     --------
     tests/test_scan.py to clarify regular expressions
     """
-    vowels_or_clusters = re.compile("[AEÉIOUaeéiouy]+")
-    vowel_split = re.compile("[aiouy]é|ao|eo[^u]|ia[^n]|[^ct]ian|iet|io[^nu]|[^c]iu|[^gq]ua|[^gq]ue[lt]|[^q]uo|[aeiouy]ing|[aeiou]y[aiou]") # exceptions: Preus, Aida, poet, luau
-    final_e = re.compile("e$")
-    silent_final_ed_es = re.compile("[^aeiouydlrt]ed$|[^aeiouycghjlrsxz]es$|thes$|[aeiouylrw]led$|[aeiouylrw]les$|[aeiouyrw]res$|[aeiouyrw]red$")
-    lonely = re.compile("[^aeiouy]ely$")
-    audible_final_e = re.compile('[^aeiouylrw]le$|[^aeiouywr]re$|[aeioy]e|[^g]ue')
-    word_lower = word.lower()
-    voc = re.findall(vowels_or_clusters, word_lower)
+    return count_syllables(word.lower())
+
+@metrics.timed(metrics.stage_seconds, stage="syllables")
+def syllables_many(words):
+    """Guess syllable counts of many words not in database at once.
+
+    Parameters
+    ----------
+    words : iterable
+        words not found in database
+
+    Returns
+    -------
+    counts : list
+        estimated number of syllables of each word, in order
+    """
+    counts = {}
+    result = []
+    for word in words:
+        word_lower = word.lower()
+        if word_lower not in counts:
+            counts[word_lower] = count_syllables(word_lower)
+        result.append(counts[word_lower])
+    return result
+
+# patterns used by count_syllables, compiled once
+vowels_or_clusters = re.compile("[AEÉIOUaeéiouy]+")
+vowel_split = re.compile("[aiouy]é|ao|eo[^u]|ia[^n]|[^ct]ian|iet|io[^nu]|[^c]iu|[^gq]ua|[^gq]ue[lt]|[^q]uo|[aeiouy]ing|[aeiou]y[aiou]") # exceptions: Preus, Aida, poet, luau
+final_e = re.compile("e$")
+silent_final_ed_es = re.compile("[^aeiouydlrt]ed$|[^aeiouycghjlrsxz]es$|thes$|[aeiouylrw]led$|[aeiouylrw]les$|[aeiouyrw]res$|[aeiouyrw]red$")
+lonely = re.compile("[^aeiouy]ely$")
+audible_final_e = re.compile('[^aeiouylrw]le$|[^aeiouywr]re$|[aeioy]e|[^g]ue')
+
+@lru_cache(maxsize=getattr(settings, "SCAN_SYLLABLES_CACHE_SIZE", 20000))
+def count_syllables(word_lower):
+    """Guess syllable count of a lowercase word, memoizing the result.
+
+    Parameters
+    ----------
+    word_lower : str
+        lowercase word not found in database
+
+    Returns
+    -------
+    count : int
+        estimated number of syllables
+    """
+    voc = vowels_or_clusters.findall(word_lower)
     count = len(voc)
     if final_e.search(word_lower) and not audible_final_e.search(word_lower):
         count -= 1
     if silent_final_ed_es.search(word_lower) or lonely.search(word_lower):
         count -= 1
-    likely_splits = re.findall(vowel_split, word_lower)
+    likely_splits = vowel_split.findall(word_lower)
     if likely_splits:
         count += len(likely_splits)
     if count == 0:
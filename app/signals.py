@@ -0,0 +1,36 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .listing import LISTED_FIELDS, poem_listing
+from .models import Poem
+from .picker import poem_picker
+from .scan import index_poem
+
+
+# keep the ids random poems are picked from in step with the Poem table
+@receiver(post_save, sender=Poem)
+def poem_saved(sender, instance, **kwargs):
+    poem_picker.saved(instance.pk, instance.human_scanned)
+
+@receiver(post_delete, sender=Poem)
+def poem_deleted(sender, instance, **kwargs):
+    poem_picker.deleted(instance.pk)
+
+# and the word occurrence index in step with the poems' text (fixtures
+# loaded raw are indexed with the index_poems command)
+@receiver(post_save, sender=Poem)
+def poem_text_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or (update_fields is not None and "poem" not in update_fields):
+        return
+    index_poem(instance)
+
+# and the cached choose_poem pages in step with what they show
+@receiver(post_save, sender=Poem)
+def poem_listing_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not LISTED_FIELDS & set(update_fields):
+        return
+    poem_listing.invalidate()
+
+@receiver(post_delete, sender=Poem)
+def poem_listing_deleted(sender, instance, **kwargs):
+    poem_listing.invalidate()
@@ -0,0 +1,31 @@
+from contextlib import contextmanager
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# most queries each view may run for the requests in test_queries, made by
+# a logged-in user (two queries for the session and user) with cold caches
+QUERY_BUDGETS = {
+    "index": 4,
+    "index_put": 15,
+    "automated": 12,
+    "automated_scanned": 6,
+    "own_poem": 7,
+    "import_poem": 12,
+    "choose_poem": 6,
+    "choose_poem_cached": 2,
+}
+
+
+class QueryBudgetMixin:
+    """TestCase mixin asserting that code stays within a query budget."""
+
+    @contextmanager
+    def assertQueryBudget(self, name):
+        budget = QUERY_BUDGETS[name]
+        with CaptureQueriesContext(connection) as captured:
+            yield captured
+        if len(captured) > budget:
+            queries = "\n".join(f"{i}. {query['sql']}"
+                                for i, query in enumerate(captured.captured_queries, start=1))
+            self.fail(f"{name} ran {len(captured)} queries, over its budget of {budget}:\n"
+                      f"{queries}")
@@ -0,0 +1,341 @@
+from io import StringIO
+import json
+import os
+import tempfile
+from unittest import mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from app import scan
+from app.management.commands.bench_scan import isolated_database
+from app.management.commands.import_lexicon import iter_json_array
+from app.models import Pronunciation, WordStats, Poem, Algorithm, PoemScansion, WordOccurrence
+from app.parallel import parallel_scan_all
+
+
+class TestScanCorpus(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        Pronunciation.objects.create(word="water", stresses="/u", popularity=3)
+        Poem.objects.create(poem="moon squirrel")
+        Poem.objects.create(poem="squirrel moon", human_scanned=True)
+        Poem.objects.create(poem="water moon")
+        Algorithm.objects.create(name="Original Scan", about="words",
+                                 function_name="original_scan")
+        Algorithm.objects.create(name="House Robber Scan", about="words",
+                                 function_name="house_robber_scan", preferred=True)
+
+    def setUp(self):
+        scan.clear_caches()
+
+    def test_scan_corpus(self):
+        out = StringIO()
+        call_command("scan_corpus", chunk_size=2, stdout=out)
+        self.assertEqual(PoemScansion.objects.count(), 6)
+        for scansion in PoemScansion.objects.all():
+            self.assertEqual(scansion.scansion,
+                             scan.SCANS[scansion.type.function_name](scansion.poem.poem))
+        self.assertIn("Scanned 3 poems", out.getvalue())
+        self.assertIn("poems/second", out.getvalue())
+        self.assertIn("wrote 6 scansions", out.getvalue())
+
+    def test_scan_corpus_skips_existing(self):
+        call_command("scan_corpus", stdout=StringIO())
+        out = StringIO()
+        # the algorithms, the poems, the generation and the stored scansions
+        with self.assertNumQueries(4):
+            call_command("scan_corpus", stdout=out)
+        self.assertIn("wrote 0 scansions", out.getvalue())
+        self.assertEqual(PoemScansion.objects.count(), 6)
+
+    def test_scan_corpus_concurrent_insert(self):
+        poem = Poem.objects.get(poem="moon squirrel")
+        algorithm = Algorithm.objects.get(function_name="original_scan")
+
+        def scan_and_race(*args):
+            # the automated view stores a scansion while the batch is scanned
+            PoemScansion.objects.create(poem=poem, type=algorithm, scansion="stored")
+            return parallel_scan_all(*args)
+
+        out = StringIO()
+        with mock.patch("app.management.commands.scan_corpus.parallel_scan_all",
+                        side_effect=scan_and_race):
+            call_command("scan_corpus", stdout=out)
+        self.assertEqual(PoemScansion.objects.count(), 6)
+        # the row the view stored is not counted
+        self.assertIn("wrote 5 scansions", out.getvalue())
+        self.assertEqual(PoemScansion.objects.get(poem=poem, type=algorithm).scansion, "stored")
+
+    def test_scan_corpus_force(self):
+        call_command("scan_corpus", stdout=StringIO())
+        PoemScansion.objects.update(scansion="")
+        call_command("scan_corpus", force=True, stdout=StringIO())
+        self.assertFalse(PoemScansion.objects.filter(scansion="").exists())
+        self.assertEqual(PoemScansion.objects.count(), 6)
+
+    def test_scan_corpus_filters(self):
+        first = Poem.objects.get(poem="moon squirrel").pk
+        call_command("scan_corpus", "--algorithm", "original_scan",
+                     "--computer-scanned", "--min-id", str(first + 1),
+                     stdout=StringIO())
+        scansions = PoemScansion.objects.all()
+        self.assertEqual(len(scansions), 1)
+        self.assertEqual(scansions[0].poem.poem, "water moon")
+        self.assertEqual(scansions[0].type.function_name, "original_scan")
+        self.assertEqual(scansions[0].scansion, "/u / ")
+
+    def test_scan_corpus_unknown_algorithm(self):
+        with self.assertRaises(CommandError):
+            call_command("scan_corpus", "--algorithm", "no_scan", stdout=StringIO())
+
+    def test_scan_corpus_workers(self):
+        call_command("scan_corpus", workers=2, stdout=StringIO())
+        self.assertEqual(PoemScansion.objects.count(), 6)
+        for scansion in PoemScansion.objects.all():
+            self.assertEqual(scansion.scansion,
+                             scan.SCANS[scansion.type.function_name](scansion.poem.poem))
+
+
+class TestCompileLexicon(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="the", stresses="u", popularity=381)
+        Pronunciation.objects.create(word="the", stresses="/", popularity=4)
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        Pronunciation.objects.create(word="quietness", stresses="/uu", popularity=1)
+        Pronunciation.objects.create(word="quietness", stresses="/u/", popularity=1)
+        Pronunciation.objects.create(word="plié", stresses="u/", popularity=2)
+
+    def setUp(self):
+        scan.clear_caches()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "lexicon.bin")
+        settings = override_settings(SCAN_LEXICON_FILE=self.path)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.expected = {word: scan.get_stats(word, confidence=True)
+                         for word in ["the", "moon", "quietness", "plié"]}
+        scan.clear_caches()
+        call_command("compile_lexicon", stdout=StringIO())
+
+    def test_compiled_lookup(self):
+        reader = scan.compiled_lexicon()
+        self.assertEqual(reader.count, 4)
+        for word, stats in self.expected.items():
+            self.assertEqual(reader.get(word), stats)
+        self.assertIsNone(reader.get("squirrel"))
+        self.assertIsNone(reader.get("a"))
+        self.assertIsNone(reader.get("zz"))
+
+    def test_long_word(self):
+        # longer than a one-byte length allows
+        word = "é" * 200
+        Pronunciation.objects.create(word=word, stresses="u/", popularity=2)
+        call_command("compile_lexicon", stdout=StringIO())
+        reader = scan.CompiledLexicon(self.path)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.get(word), self.expected["plié"])
+        self.assertEqual(reader.get("the"), self.expected["the"])
+
+    def test_remap_closes_previous(self):
+        reader = scan.compiled_lexicon()
+        os.utime(self.path, (reader.mtime + 10, reader.mtime + 10))
+        remapped = scan.compiled_lexicon()
+        self.assertIsNot(remapped, reader)
+        self.assertTrue(reader._map.closed)
+        self.assertIsNone(reader.lookup("the"))
+        self.assertEqual(remapped.get("the"), self.expected["the"])
+
+    def test_unreadable_file(self):
+        with open(self.path, "wb") as f:
+            f.write(b"SCANLEX1" + bytes(16))
+        self.assertIsNone(scan.compiled_lexicon())
+        self.assertEqual(scan.get_stats("moon"), self.expected["moon"][0])
+
+    def test_lexicon_stats_reads_file(self):
+        scan.lexicon_stats(["the"])
+        scan.clear_caches()
+        # once stale words have been checked, known words need no queries
+        with self.assertNumQueries(0):
+            stats = scan.lexicon_stats(self.expected)
+        self.assertEqual(stats, self.expected)
+
+    def test_database_fallback(self):
+        self.assertEqual(scan.get_stats("squirrel"), ["?", "?"])
+        Pronunciation.objects.create(word="cat", stresses="/", popularity=1)
+        self.assertEqual(scan.get_stats("cat"), [2.0])
+
+    def test_changed_words_skip_file(self):
+        self.assertEqual(self.expected["moon"], ([30.0], 15))
+        scan.record("moon", "u")
+        self.assertEqual(scan.get_stats("moon"), [14.8515])
+        # other processes find out from WordStats
+        scan.compiled.close()
+        scan.compiled = None
+        scan.clear_caches()
+        self.assertEqual(scan.get_stats("moon"), [14.8515])
+        self.assertEqual(scan.get_stats("the"), self.expected["the"][0])
+
+    def test_parallel_maps_file(self):
+        poems = ["the moon", "moon squirrel quietness", "the the moon"]
+        names = ["house_robber_scan", "prose_scan"]
+        expected = [scan.scan_all(poem, names) for poem in poems]
+        scan.clear_caches()
+        self.assertEqual(parallel_scan_all(poems, names, workers=2), expected)
+        self.assertEqual(parallel_scan_all(poems, names, workers=1), expected)
+
+
+class TestImportLexicon(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+
+    def setUp(self):
+        scan.clear_caches()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def patterns(self, word):
+        return list(Pronunciation.objects.filter(word=word).order_by("stresses")
+                    .values_list("stresses", "popularity"))
+
+    def test_import_fixture(self):
+        path = self.write("data.json", """[
+            {"model": "app.pronunciation", "pk": 1,
+             "fields": {"word": "moon", "stresses": "/", "popularity": 3}},
+            {"model": "app.poem", "pk": 1, "fields": {"poem": "moon"}},
+            {"model": "app.pronunciation", "pk": 2,
+             "fields": {"word": "water", "stresses": "/u", "popularity": 3}},
+            {"model": "app.pronunciation", "pk": 3,
+             "fields": {"word": "Plié", "stresses": "u/", "popularity": 2}}
+        ]""")
+        out = StringIO()
+        call_command("import_lexicon", path, chunk_size=1, stdout=out)
+        self.assertEqual(self.patterns("moon"), [("/", 15)])
+        self.assertEqual(self.patterns("water"), [("/u", 3)])
+        self.assertEqual(self.patterns("plié"), [("u/", 2)])
+        self.assertEqual(WordStats.objects.get(word="water").ratios, [6.0, 0.0333])
+        self.assertEqual(scan.get_stats("water"), [6.0, 0.0333])
+        self.assertIn("Imported 3 entries", out.getvalue())
+        self.assertIn("Skipped 1 objects that are not pronunciations (app.poem: 1)",
+                      out.getvalue())
+
+    def test_import_fixture_small_reads(self):
+        path = self.write("data.json", '[{"model": "app.pronunciation", '
+                          '"fields": {"word": "water", "stresses": "/u", "popularity": 12}}]')
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(len(list(iter_json_array(f, read_size=3))), 1)
+
+    def test_import_merge(self):
+        path = self.write("words.txt", "# word stresses popularity\nmoon / 2\nmoon u\nthe u 5\n")
+        call_command("import_lexicon", path, "--merge", stdout=StringIO())
+        self.assertEqual(self.patterns("moon"), [("/", 17), ("u", 1)])
+        self.assertEqual(self.patterns("the"), [("u", 5)])
+
+    def test_import_cmudict(self):
+        path = self.write("cmudict.dict", ";;; comment\n"
+                          "ABANDON  AH0 B AE1 N D AH0 N\n"
+                          "WATERMELON  W AO1 T ER0 M EH2 L AH0 N\n"
+                          "THE  DH AH0\nTHE(2)  DH IY1\n")
+        call_command("import_lexicon", path, "--format", "cmudict", stdout=StringIO())
+        self.assertEqual(self.patterns("abandon"), [("u/u", 1)])
+        self.assertEqual(self.patterns("watermelon"), [("/u/u", 1)])
+        self.assertEqual(self.patterns("the"), [("/", 1), ("u", 1)])
+
+    def test_import_bad_line(self):
+        path = self.write("words.txt", "moon\n")
+        with self.assertRaises(CommandError):
+            call_command("import_lexicon", path, stdout=StringIO())
+
+    def test_import_bad_popularity(self):
+        path = self.write("words.txt", "the u 5\nmoon / lots\n")
+        with self.assertRaisesMessage(CommandError, "Line 2: popularity"):
+            call_command("import_lexicon", path, stdout=StringIO())
+
+    def test_import_duplicates_across_chunks(self):
+        path = self.write("words.txt", "the u 2\nmoon / 2\nthe / 1\nthe u 3\nmoon / 4\n")
+        call_command("import_lexicon", path, chunk_size=1, stdout=StringIO())
+        # summed as they would be in one chunk; moon was there already
+        self.assertEqual(self.patterns("the"), [("/", 1), ("u", 5)])
+        self.assertEqual(self.patterns("moon"), [("/", 15)])
+
+
+class TestIndexPoems(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Poem.objects.create(poem="moon squirrel")
+        Poem.objects.create(poem="the moons")
+        Poem.objects.create(poem="water")
+
+    def test_index_poems(self):
+        WordOccurrence.objects.all().delete()
+        WordOccurrence.objects.create(word="gone", poem=Poem.objects.get(poem="water"))
+        out = StringIO()
+        call_command("index_poems", chunk_size=2, stdout=out)
+        self.assertIn("Indexed 3 poems", out.getvalue())
+        for poem in Poem.objects.all():
+            self.assertEqual(set(poem.wordoccurrence_set.values_list("word", flat=True)),
+                             scan.poem_words(poem.poem))
+
+
+class TestBenchScan(TestCase):
+    def setUp(self):
+        scan.clear_caches()
+
+    def test_bench_scan(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "bench.json")
+            baseline = os.path.join(directory, "baseline.json")
+            call_command("bench_scan", sizes="2,3", vocabulary=40, repeat=1,
+                         output=output, save_baseline=baseline, stdout=StringIO())
+            with open(output) as f:
+                results = json.load(f)
+            self.assertEqual(list(results["sizes"]), ["2", "3"])
+            stages = results["sizes"]["3"]
+            self.assertEqual(stages["poems"], 3)
+            for name in ["get_stats", "poem_stats", "syllables", "original_scan",
+                         "house_robber_scan", "prose_scan", "record"]:
+                self.assertGreaterEqual(stages[name]["seconds"], 0)
+            self.assertEqual(stages["record"]["operations"], 3)
+            # the synthetic lexicon and recordings are made elsewhere
+            self.assertFalse(Pronunciation.objects.exists())
+            self.assertFalse(WordStats.objects.exists())
+
+            # the same seed gives the same corpus
+            err = StringIO()
+            call_command("bench_scan", sizes="2,3", vocabulary=40, repeat=1, output=output,
+                         baseline=baseline, tolerance=100, stdout=StringIO(), stderr=err)
+            self.assertIn("No regressions", err.getvalue())
+            with open(output) as f:
+                self.assertEqual(json.load(f)["sizes"]["3"]["words"], stages["words"])
+
+            # a stage slower than the baseline fails the run
+            for size in results["sizes"].values():
+                size["poem_stats"]["seconds"] = 1e-9
+            with open(baseline, "w") as f:
+                json.dump(results, f)
+            with self.assertRaisesMessage(CommandError, "poem_stats on 3 poems"):
+                call_command("bench_scan", sizes="2,3", vocabulary=40, repeat=1, output=output,
+                             baseline=baseline, min_seconds=0, stdout=StringIO())
+
+    def test_isolated_database(self):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        with isolated_database():
+            # the configured database's lexicon is not mixed in
+            self.assertFalse(Pronunciation.objects.exists())
+            Pronunciation.objects.create(word="cat", stresses="/", popularity=1)
+        self.assertEqual(list(Pronunciation.objects.values_list("word", flat=True)), ["moon"])
+
+    def test_bench_scan_database(self):
+        for alias, message in [("default", "scratch database"), ("nope", "No database")]:
+            with self.assertRaisesMessage(CommandError, message):
+                call_command("bench_scan", database=alias, stdout=StringIO())
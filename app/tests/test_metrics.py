@@ -0,0 +1,80 @@
+from django.test import TestCase
+from django.urls import reverse
+from app.models import Pronunciation
+from app import metrics, scan
+
+
+class TestHistogram(TestCase):
+    def setUp(self):
+        self.histogram = metrics.Histogram("test_seconds", "Test.", labels=("stage",),
+                                           buckets=(0.1, 1.0))
+        metrics.registry.remove(self.histogram)
+
+    def test_observe(self):
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            self.histogram.observe(value, stage="a")
+        self.assertEqual(self.histogram.count(stage="a"), 4)
+        self.assertEqual(self.histogram.count(stage="b"), 0)
+        self.assertEqual(list(self.histogram.samples()), [
+            'test_seconds_bucket{stage="a",le="0.1"} 2',
+            'test_seconds_bucket{stage="a",le="1"} 3',
+            'test_seconds_bucket{stage="a",le="+Inf"} 4',
+            'test_seconds_sum{stage="a"} 2.65',
+            'test_seconds_count{stage="a"} 4',
+        ])
+
+    def test_quantile(self):
+        self.assertIsNone(self.histogram.quantile(0.5, stage="a"))
+        for value in [0.05, 0.05, 0.5, 0.5]:
+            self.histogram.observe(value, stage="a")
+        self.assertAlmostEqual(self.histogram.quantile(0.5, stage="a"), 0.1)
+        self.assertAlmostEqual(self.histogram.quantile(0.75, stage="a"), 0.55)
+        self.histogram.observe(5.0, stage="a")
+        self.assertEqual(self.histogram.quantile(0.99, stage="a"), 1.0)
+
+    def test_timed_nested(self):
+        with metrics.timed(self.histogram, stage="a"):
+            with metrics.timed(self.histogram, stage="a"):
+                pass
+            with metrics.timed(self.histogram, stage="b"):
+                pass
+        self.assertEqual(self.histogram.count(stage="a"), 1)
+        self.assertEqual(self.histogram.count(stage="b"), 1)
+
+
+class TestScanMetrics(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=1)
+        Pronunciation.objects.create(word="squirrel", stresses="/u", popularity=1)
+
+    def setUp(self):
+        scan.clear_caches()
+        metrics.reset()
+
+    def test_scan_all(self):
+        scan.scan_all("moon squirrel\nthe moon", ["house_robber_scan", "prose_scan"])
+        for stage in ["tokenize", "lookup", "syllables"]:
+            self.assertEqual(metrics.stage_seconds.count(stage=stage), 1)
+        self.assertEqual(metrics.algorithm_seconds.count(algorithm="house_robber_scan"), 1)
+        self.assertEqual(metrics.algorithm_seconds.count(algorithm="prose_scan"), 1)
+        self.assertEqual(metrics.poems_total.value(), 1)
+        self.assertEqual(metrics.words_total.value(), 4)
+        self.assertEqual(metrics.unknown_words_total.value(), 1)
+        self.assertEqual(metrics.syllables_total.value(), 5)
+        # scansions served from the cache run no algorithm
+        scan.scan_all("moon squirrel\nthe moon", ["house_robber_scan"])
+        self.assertEqual(metrics.algorithm_seconds.count(algorithm="house_robber_scan"), 1)
+
+    def test_metrics_view(self):
+        scan.scan_all("moon squirrel", ["house_robber_scan"])
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = response.content.decode()
+        self.assertIn("# TYPE scan_stage_seconds histogram", text)
+        self.assertIn('scan_stage_seconds_count{stage="lookup"} 1', text)
+        self.assertIn('scan_algorithm_seconds_bucket{algorithm="house_robber_scan",le="+Inf"} 1',
+                      text)
+        self.assertIn("scan_words_total 2", text)
+        self.assertIn("scan_unknown_words_total 0", text)
@@ -0,0 +1,32 @@
+from django.test import TestCase
+from app import scan
+from app.models import Pronunciation
+from app.parallel import parallel_scan_all
+
+
+class TestParallel(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="the", stresses="u", popularity=381)
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        Pronunciation.objects.create(word="water", stresses="/u", popularity=3)
+
+    def setUp(self):
+        scan.clear_caches()
+
+    def test_parallel_matches_scan_all(self):
+        poems = ["the moon", "water the moon\nsquirrel", "", "moon water the"] * 5
+        names = ["house_robber_scan", "original_scan"]
+        results = parallel_scan_all(poems, names, workers=3)
+        self.assertEqual(results, [scan.scan_all(poem, names) for poem in poems])
+
+    def test_parallel_single_lookup(self):
+        poems = ["the moon", "water squirrel", "moon water"]
+        scan.known_words()
+        with self.assertNumQueries(2):
+            results = parallel_scan_all(poems, ["prose_scan"], workers=1)
+        self.assertEqual(results[2], {"prose_scan": "/ /u "})
+
+    def test_parallel_empty(self):
+        self.assertEqual(parallel_scan_all([], ["prose_scan"]), [])
+        self.assertEqual(parallel_scan_all(["moon"], []), [{}])
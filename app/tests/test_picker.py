@@ -0,0 +1,77 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from app.models import Poem
+from app.picker import IdSample, PoemPicker, poem_picker
+
+
+class TestIdSample(SimpleTestCase):
+    def test_add_discard(self):
+        sample = IdSample([1, 2, 3])
+        sample.add(2)
+        self.assertEqual(len(sample), 3)
+        sample.discard(1)
+        sample.discard(5)
+        self.assertEqual(sorted(sample.ids), [2, 3])
+        self.assertNotIn(1, sample)
+        for _ in range(20):
+            self.assertIn(sample.choice(), (2, 3))
+
+    def test_empty(self):
+        sample = IdSample([4])
+        sample.discard(4)
+        self.assertIsNone(sample.choice())
+
+
+class TestPoemPicker(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.human = Poem.objects.create(poem="moon squirrel", human_scanned=True)
+        cls.computer = Poem.objects.create(poem="squirrel moon")
+
+    def setUp(self):
+        poem_picker.invalidate()
+
+    def test_human_scanned(self):
+        for _ in range(10):
+            self.assertEqual(poem_picker.random_poem(human_scanned=True), self.human)
+
+    def test_all(self):
+        picked = {poem_picker.random_poem() for _ in range(50)}
+        self.assertEqual(picked, {self.human, self.computer})
+
+    def test_ids_cached(self):
+        poem_picker.random_poem()
+        with CaptureQueriesContext(connection) as queries:
+            poem_picker.random_poem()
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("RANDOM", queries[0]["sql"].upper())
+
+    def test_signals(self):
+        poem_picker.random_poem()
+        self.computer.human_scanned = True
+        self.computer.save()
+        new = Poem.objects.create(poem="the moon", human_scanned=True)
+        self.human.delete()
+        picked = {poem_picker.random_poem(human_scanned=True) for _ in range(50)}
+        self.assertEqual(picked, {self.computer, new})
+
+    def test_changed_elsewhere(self):
+        picker = PoemPicker(ttl=300)
+        picker.random_poem()
+        # queryset updates do not send signals, like changes by other processes
+        Poem.objects.filter(pk=self.human.pk).update(human_scanned=False)
+        self.assertIsNone(picker.random_poem(human_scanned=True))
+        Poem.objects.filter(pk=self.computer.pk).delete()
+        self.assertEqual(picker.random_poem(), self.human)
+
+    def test_ttl(self):
+        picker = PoemPicker(ttl=0)
+        picker.random_poem()
+        Poem.objects.filter(pk=self.computer.pk).update(human_scanned=True)
+        picked = {picker.random_poem(human_scanned=True) for _ in range(50)}
+        self.assertEqual(len(picked), 2)
+
+    def test_empty(self):
+        Poem.objects.all().delete()
+        self.assertIsNone(poem_picker.random_poem())
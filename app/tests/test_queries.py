@@ -0,0 +1,140 @@
+import json
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from app.middleware import QueryLogMiddleware, QueryRecorder
+from app.listing import poem_listing
+from app.models import User, Poem, Algorithm, Pronunciation, PoemScansion
+from app import scan
+from .budgets import QueryBudgetMixin
+
+
+class TestQueryRecorder(TestCase):
+    def test_recorder(self):
+        with QueryRecorder(slowest=2) as recorder:
+            list(Poem.objects.all())
+            Poem.objects.count()
+            Pronunciation.objects.exists()
+        self.assertEqual(recorder.count, 3)
+        self.assertGreater(recorder.seconds, 0)
+        stats = recorder.stats()
+        self.assertEqual(stats["queries"], 3)
+        self.assertEqual(len(stats["slowest"]), 2)
+        self.assertGreaterEqual(stats["slowest"][0]["ms"], stats["slowest"][1]["ms"])
+        # and the wrapper is removed on exit
+        Poem.objects.count()
+        self.assertEqual(recorder.count, 3)
+
+
+class TestQueryLogMiddleware(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Poem.objects.create(poem="moon squirrel", human_scanned=True)
+
+    def setUp(self):
+        poem_listing.invalidate()
+
+    def test_off_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            QueryLogMiddleware(lambda request: HttpResponse())
+
+    @override_settings(SCAN_QUERY_LOGGING=True, SCAN_QUERY_LOG_SLOWEST=1)
+    def test_logs_queries(self):
+        with self.assertLogs("app.queries", "INFO") as logs:
+            response = self.client.get(reverse("choose_poem"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(logs.records), 1)
+        stats = logs.records[0].query_stats
+        self.assertEqual(stats["view"], "choose_poem")
+        self.assertEqual(stats["method"], "GET")
+        self.assertEqual(stats["status"], 200)
+        self.assertEqual(stats["queries"], 2)
+        self.assertIn("app_poem", stats["slowest"][0]["sql"])
+        json.dumps(stats)
+
+
+class TestQueryBudgets(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Poem.objects.create(poem="moon squirrel", scansion="/ u/ ", human_scanned=True)
+        Poem.objects.create(poem="squirrel moon")
+        Algorithm.objects.create(name="Original Scan",
+                                 about="words",
+                                 function_name="original_scan")
+        Algorithm.objects.create(name="House Robber Scan",
+                                 about="words",
+                                 function_name="house_robber_scan",
+                                 preferred=True)
+        User.objects.create_superuser("someone", password="12345", points=10, promoted=True)
+
+    def setUp(self):
+        scan.clear_caches()
+        poem_listing.invalidate()
+        self.client.login(username="someone", password="12345")
+
+    def test_index(self):
+        with self.assertQueryBudget("index"):
+            response = self.client.get(reverse("index"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.context["poem"].pk)
+
+    def test_index_put(self):
+        poem = Poem.objects.get(poem="squirrel moon")
+        with self.assertQueryBudget("index_put"):
+            response = self.client.put(reverse("index"),
+                                       json.dumps({"id": poem.pk, "scansion": "/u / "}))
+        self.assertEqual(response.status_code, 200)
+        poem.refresh_from_db()
+        self.assertEqual(poem.scansion, "/u / ")
+        self.assertTrue(poem.human_scanned)
+        self.assertEqual(list(Pronunciation.objects.filter(word="squirrel")
+                              .values_list("stresses", "popularity")), [("/u", 1)])
+
+    def test_automated(self):
+        poem = Poem.objects.get(poem="squirrel moon")
+        with self.assertQueryBudget("automated"):
+            response = self.client.get(reverse("automated", kwargs={"id": poem.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PoemScansion.objects.filter(poem=poem).count(), 2)
+        with self.assertQueryBudget("automated_scanned"):
+            response = self.client.get(reverse("automated", kwargs={"id": poem.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s.pk for s in response.context["scansions"]],
+                         list(PoemScansion.objects.filter(poem=poem)
+                              .order_by("-type__preferred").values_list("pk", flat=True)))
+
+    def test_own_poem(self):
+        with self.assertQueryBudget("own_poem"):
+            response = self.client.post(reverse("own_poem"),
+                                        {"title": "", "poem": "moon squirrel", "poet": ""})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["scansions"]), 2)
+        self.assertTrue(all(s.scansion for s in response.context["scansions"]))
+
+    def test_import_poem(self):
+        with self.assertQueryBudget("import_poem"):
+            response = self.client.post(reverse("import_poem"),
+                                        {"title": "", "poem": "the moon\nis here", "poet": ""})
+        self.assertEqual(response.status_code, 200)
+        poem = Poem.objects.get(poem="the moon\nis here")
+        self.assertEqual(poem.scansion, response.content.decode())
+        self.assertTrue(poem.scansion)
+
+    def test_choose_poem(self):
+        with self.assertQueryBudget("choose_poem"):
+            response = self.client.get(reverse("choose_poem"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["human_list"]), 1)
+        self.assertEqual(len(response.context["computer_list"]), 1)
+        with self.assertQueryBudget("choose_poem_cached"):
+            response = self.client.get(reverse("choose_poem"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["human_list"]), 1)
+        self.assertEqual(len(response.context["computer_list"]), 1)
+
+    def test_over_budget(self):
+        with self.assertRaisesMessage(AssertionError, "over its budget of 6"):
+            with self.assertQueryBudget("choose_poem"):
+                for _ in range(7):
+                    Poem.objects.count()
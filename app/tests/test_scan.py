@@ -1,6 +1,14 @@
-from django.test import TestCase
-from app.scan import get_stats, poem_stats, original_scan, house_robber_scan, record, syllables
-from app.models import Pronunciation
+from copy import copy
+from io import StringIO
+import random
+import time
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from app.scan import poem_words, index_poem, changed_poem_ids, bump_generation, lexicon_generation, sync_lexicon, words_generation, refresh_scansions, refresh_word_stats, bump_lexicon_version, SCANS, LRUCache, tokenize, stats_cache, scansion_cache, poem_key, clear_caches, derive_stems, known_words, get_stats, lexicon_stats, poem_stats, original_scan, house_robber_line, house_robber_scan, prose_scan, scan_all, record, syllables, syllables_many, count_syllables
+from app.models import Algorithm, LexiconState, Poem, PoemScansion, Pronunciation, WordOccurrence, WordStats
 
 
 class TestStats(TestCase):
@@ -43,8 +51,8 @@ class TestStats(TestCase):
         Pronunciation.objects.create(word="beloved", stresses="u/", popularity=1)
         Pronunciation.objects.create(word="beloved", stresses="u/u", popularity=1)
 
-
-
+    def setUp(self):
+        clear_caches()
 
     def test_capitalization(self):
         print(get_stats("the"))
@@ -96,6 +104,130 @@ class TestStats(TestCase):
                      0.2665, " ", 0.4975, " ", "?", " "]]
         self.assertEqual(poem_stats(line), scansion)
 
+    def test_tokenize(self):
+        poem = "THE moon,\r\n\n  Home-bound. the"
+        lines = tokenize(poem)
+        self.assertEqual([len(tokens) for tokens in lines], [2, 0, 2])
+        self.assertEqual([(t.text, t.norm, t.line) for t in lines[2]],
+                         [("Home-bound.", "homebound", 2), ("the", "the", 2)])
+        for tokens in lines:
+            for token in tokens:
+                self.assertEqual(poem[token.start:token.end], token.text)
+        self.assertFalse(hasattr(lines[0][0], "__dict__"))
+
+    def test_lexicon_stats_matches_get_stats(self):
+        words = ["the", "quietness", "beloved", "an", "squirrel", "the"]
+        stats = lexicon_stats(words)
+        self.assertEqual(len(stats), 5)
+        for word in words:
+            self.assertEqual(stats[word], get_stats(word, confidence=True))
+
+    def test_poem_stats_single_query(self):
+        call_command("rebuild_word_stats", stdout=StringIO())
+        poem = "THE moon is a wavering rim\nwhere one fish slips,"
+        with self.assertNumQueries(1):
+            poem_stats(poem)
+
+    def test_stats_cache_hit(self):
+        get_stats("moon")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_stats("Moon"), [14.8515])
+        self.assertEqual(stats_cache.info()["hits"], 1)
+        self.assertEqual(stats_cache.info()["misses"], 1)
+        self.assertEqual(stats_cache.info()["size"], 1)
+
+    def test_stats_cache_returns_copies(self):
+        get_stats("moon").append(0)
+        self.assertEqual(get_stats("moon"), [14.8515])
+
+    def test_stats_cache_invalidated_by_record(self):
+        self.assertEqual(get_stats("cat"), ["?"])
+        record("cat", "/")
+        self.assertEqual(get_stats("cat"), [2.0])
+
+    def test_rebuild_word_stats(self):
+        words = ["the", "quietness", "beloved", "an", "wavering"]
+        expected = {word: get_stats(word, confidence=True) for word in words}
+        call_command("rebuild_word_stats", stdout=StringIO())
+        self.assertEqual(WordStats.objects.count(), 22)
+        clear_caches()
+        for word in words:
+            ws = WordStats.objects.get(word=word)
+            self.assertEqual((ws.ratios, ws.popularity), expected[word])
+            self.assertEqual(ws.syllables, len(ws.ratios))
+            self.assertEqual(get_stats(word, confidence=True), expected[word])
+
+    def test_rebuild_word_stats_keeps_unchanged_rows(self):
+        call_command("rebuild_word_stats", stdout=StringIO())
+        before = dict(WordStats.objects.values_list("word", "updated"))
+        generation = lexicon_generation()
+        moon = Pronunciation.objects.filter(word="moon").first()
+        moon.popularity += 1
+        moon.save()
+        Pronunciation.objects.filter(word="an").delete()
+        out = StringIO()
+        call_command("rebuild_word_stats", stdout=out)
+        self.assertIn("(0 created, 1 updated, 1 removed)", out.getvalue())
+        after = dict(WordStats.objects.values_list("word", "updated"))
+        self.assertNotIn("an", after)
+        self.assertGreater(after.pop("moon"), before["moon"])
+        self.assertEqual(after, {word: updated for word, updated in before.items()
+                                 if word not in ("moon", "an")})
+        # only the changed word is stamped with a new generation
+        self.assertEqual(lexicon_generation(), generation + 1)
+        self.assertEqual(set(WordStats.objects.filter(generation=generation + 1)
+                             .values_list("word", flat=True)), {"moon"})
+
+    def test_record_updates_word_stats(self):
+        call_command("rebuild_word_stats", stdout=StringIO())
+        record("moon cat", "/ u")
+        self.assertEqual(WordStats.objects.get(word="moon").ratios, [15.8416])
+        cat = WordStats.objects.get(word="cat")
+        self.assertEqual((cat.syllables, cat.ratios, cat.popularity),
+                         (1, [0.1], 1))
+        self.assertEqual(get_stats("cat"), [0.1])
+
+    def test_derive_stems(self):
+        for word, stresses in [("horse", "/"), ("carry", "/u"), ("love", "/"),
+                               ("stop", "/"), ("hate", "/"), ("hat", "/"), ("happy", "/u")]:
+            Pronunciation.objects.create(word=word, stresses=stresses, popularity=1)
+        self.assertEqual(derive_stems(["moons", "horses", "carried", "loving", "stopping",
+                                       "hated", "lovd", "happiness", "moonless", "squirrel"]),
+                         {"moons": ("moon", 0), "horses": ("horse", 1), "carried": ("carry", 0),
+                          "loving": ("love", 1), "stopping": ("stop", 1), "hated": ("hate", 1),
+                          "lovd": ("love", 0), "happiness": ("happy", 1),
+                          "moonless": ("moon", 1)})
+
+    def test_stem_fallback(self):
+        self.assertEqual(get_stats("moons", confidence=True), get_stats("moon", confidence=True))
+        self.assertEqual(get_stats("moonless", confidence=True), ([14.8515, 0.1], 16))
+        self.assertEqual(get_stats("squirrel"), ["?", "?"])
+        # derived words follow changes to their stem
+        record("moon", "/")
+        self.assertEqual(get_stats("moons"), get_stats("moon"))
+        # and stop being derived once they are known themselves
+        record("moons", "u")
+        self.assertEqual(get_stats("moons"), [0.1])
+
+    def test_stem_index_learns_recorded_words(self):
+        self.assertEqual(derive_stems(["cats"]), {})
+        record("cat", "/")
+        self.assertEqual(get_stats("cats"), [2.0])
+
+    @override_settings(SCAN_STEM_FALLBACK=False)
+    def test_stem_fallback_disabled(self):
+        self.assertEqual(get_stats("moons"), ["?"])
+
+    def test_stats_cache_eviction(self):
+        cache = LRUCache(2)
+        cache.set("the", 1)
+        cache.set("moon", 2)
+        cache.get("the")
+        cache.set("is", 3)
+        self.assertEqual(cache.get("moon"), None)
+        self.assertEqual(cache.get("the"), 1)
+        self.assertEqual(cache.get("is"), 3)
+
     def test_original_unambiguous(self):
         self.assertEqual(original_scan("water moon"), "/u / ")
 
@@ -155,6 +287,46 @@ class TestStats(TestCase):
     def test_house_robber_stressed_unknown(self):
         self.assertEqual(house_robber_scan("moon bird"), "/ u ")
 
+    def test_scan_all(self):
+        poem = "The water makes a quietness of sound;\n\nmoon squirrel"
+        names = ["house_robber_scan", "original_scan", "prose_scan"]
+        # the stem index is loaded once per process, not per poem
+        known_words()
+        with self.assertNumQueries(2):
+            scansions = scan_all(poem, names)
+        self.assertEqual(list(scansions), names)
+        self.assertEqual(scansions["house_robber_scan"], house_robber_scan(poem))
+        self.assertEqual(scansions["original_scan"], original_scan(poem))
+        self.assertEqual(scansions["prose_scan"], prose_scan(poem))
+        self.assertEqual(scan_all(poem, []), {})
+
+    def test_scan_all_cached(self):
+        names = ["house_robber_scan", "prose_scan"]
+        scansions = scan_all("The moon is a squirrel", names)
+        with self.assertNumQueries(0):
+            self.assertEqual(scan_all("the MOON, is a squirrel!", names[::-1]), scansions)
+        self.assertEqual(list(scan_all("the moon is a squirrel", names)), names)
+        self.assertEqual(scansion_cache.info()["size"], 2)
+
+    def test_scan_all_cache_invalidated_by_record(self):
+        self.assertEqual(scan_all("moon cat", ["prose_scan"]), {"prose_scan": "/ ? "})
+        record("cat", "/")
+        self.assertEqual(scan_all("moon cat", ["prose_scan"]), {"prose_scan": "/ / "})
+
+    def test_scan_all_not_cached_across_versions(self):
+        def changing_scan(poem, stress_list):
+            # the lexicon changes while the poem is scanned
+            bump_lexicon_version()
+            return prose_scan(poem, stress_list=stress_list)
+        with mock.patch.dict(SCANS, {"prose_scan": changing_scan}):
+            scan_all("moon cat", ["prose_scan"])
+        self.assertEqual(scansion_cache.info()["size"], 0)
+
+    def test_poem_key(self):
+        self.assertEqual(poem_key(tokenize("The moon,\n  is")), poem_key(tokenize("the moon\r\nis;")))
+        self.assertNotEqual(poem_key(tokenize("the moon\nis")), poem_key(tokenize("the\nmoon is")))
+        self.assertNotEqual(poem_key(tokenize("the moon")), poem_key(tokenize("themoon")))
+
     def test_record_unknown(self):
         record("cat", "/")
         w = Pronunciation.objects.filter(word="cat")
@@ -180,6 +352,44 @@ class TestStats(TestCase):
                           w[1].stresses, w[1].popularity),
                          ("/uu", 1, "/u/", 1))
 
+    def test_syllables_many(self):
+        self.assertEqual(syllables_many(["squirrel", "Chaos", "aped", "squirrel"]),
+                         [2, 2, 1, 2])
+        self.assertEqual(syllables_many([]), [])
+
+    def test_syllables_memoized(self):
+        syllables("Perdition")
+        hits = count_syllables.cache_info().hits
+        self.assertEqual(syllables("perdition"), 3)
+        self.assertEqual(count_syllables.cache_info().hits, hits + 1)
+
+    def test_record_repeated_words(self):
+        record("moon cat moon\ncat Cat", "/ / u\n/ /")
+        moon = Pronunciation.objects.filter(word="moon").order_by("stresses")
+        self.assertEqual([(p.stresses, p.popularity) for p in moon],
+                         [("/", 16), ("u", 2)])
+        cat = Pronunciation.objects.filter(word="cat")
+        self.assertEqual([(p.stresses, p.popularity) for p in cat], [("/", 3)])
+
+    def test_record_query_count(self):
+        # the number of queries does not grow with the length of the poem:
+        # both poems update the stats of known words and create some for new ones
+        call_command("rebuild_word_stats", stdout=StringIO())
+        with CaptureQueriesContext(connection) as short:
+            record("moon cat", "/ /")
+        with CaptureQueriesContext(connection) as long:
+            record("the moon is a wavering rim\nwhere one fish slips dog and hound",
+                   "u / u u /uu /\nu / u / / u /")
+        self.assertEqual(len(short), 11)
+        self.assertEqual(len(long), len(short))
+
+    def test_record_is_atomic(self):
+        # a scansion with too few words fails without recording anything
+        with self.assertRaises(IndexError):
+            record("moon cat", "/")
+        self.assertFalse(Pronunciation.objects.filter(word="cat").exists())
+        self.assertEqual(Pronunciation.objects.get(word="moon", stresses="/").popularity, 15)
+
     def test_simple_syll(self):
         self.assertEqual(syllables("squirrel"), 2)
 
@@ -262,3 +472,231 @@ class TestStats(TestCase):
         self.assertEqual(syllables("pares"), 1)
         self.assertEqual(syllables("barres"), 1)
         self.assertEqual(syllables("awes"), 1)
+
+
+def quadratic_house_robber_line(line):
+    """Previous list-copying house robber implementation, for comparison."""
+    spaceless_line = []
+    for i, value in enumerate(line):
+        if value != " ":
+            if value == "?":
+                spaceless_line.append((0.3, i))
+            else:
+                spaceless_line.append((value, i))
+    prev1 = []
+    prev2 = []
+    for pair in spaceless_line:
+        tmp = copy(prev1)
+        if sum(p[0] for p in prev1) <= sum(p[0] for p in prev2) + pair[0]:
+            prev2.append(pair)
+            prev1 = copy(prev2)
+        prev2 = copy(tmp)
+    line_scansion = ""
+    for i, value in enumerate(line):
+        if value == " ":
+            line_scansion += value
+        elif [pair for pair in prev1 if pair[1] == i]:
+            line_scansion += "/"
+        else:
+            line_scansion += "u"
+    return line_scansion
+
+def random_line(rng, words):
+    line = []
+    for _ in range(words):
+        for _ in range(rng.randint(1, 3)):
+            line.append(rng.choice(["?", 0.0067, 0.1, 0.3258, 1.2716, 2.0, 14.8515]))
+        line.append(" ")
+    return line
+
+class TestGeneration(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        Pronunciation.objects.create(word="the", stresses="u", popularity=381)
+        Pronunciation.objects.create(word="water", stresses="/u", popularity=3)
+        cls.poem = Poem.objects.create(poem="the moon squirrels")
+        cls.algorithm = Algorithm.objects.create(name="Prose", about="words",
+                                                 function_name="prose_scan")
+        call_command("rebuild_word_stats", stdout=StringIO())
+
+    def setUp(self):
+        clear_caches()
+
+    def stored_scansion(self, poem):
+        generation = sync_lexicon()
+        return PoemScansion.objects.create(poem=self.poem, type=self.algorithm,
+                                           scansion=scan_all(poem, ["prose_scan"])["prose_scan"],
+                                           generation=generation)
+
+    def test_record_bumps_generation(self):
+        before = lexicon_generation()
+        built = WordStats.objects.get(word="water").generation
+        record("moon cat", "/ /")
+        self.assertEqual(lexicon_generation(), before + 1)
+        self.assertEqual(WordStats.objects.get(word="cat").generation, before + 1)
+        self.assertEqual(WordStats.objects.get(word="moon").generation, before + 1)
+        self.assertEqual(WordStats.objects.get(word="water").generation, built)
+        self.assertEqual(words_generation(["water", "the"]), built)
+        self.assertEqual(words_generation(["water", "moon", "nowhere"]), before + 1)
+
+    def test_rebuild_word_stats_new_words_outdate_scansions(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        self.assertEqual(scansion.scansion, "u / ?? ")
+        # squirrel is added behind the module's back, as loaddata would
+        Pronunciation.objects.bulk_create([Pronunciation(word="squirrel", stresses="/u",
+                                                         popularity=1)])
+        call_command("rebuild_word_stats", stdout=StringIO())
+        self.assertEqual(WordStats.objects.get(word="squirrel").generation,
+                         lexicon_generation())
+        out = StringIO()
+        call_command("sweep_scansions", stdout=out)
+        self.assertIn("rescanned 1", out.getvalue())
+        scansion.refresh_from_db()
+        self.assertEqual(scansion.scansion, "u / /u ")
+
+    def test_words_generation_follows_stems(self):
+        record("squirrel", "/u")
+        self.assertEqual(words_generation(["the", "squirrels"]), lexicon_generation())
+
+    def test_refresh_scansions_unchanged_words(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        record("water", "u/")
+        generation = sync_lexicon()
+        scansion = PoemScansion.objects.select_related("type").get(pk=scansion.pk)
+        self.assertEqual(refresh_scansions(self.poem.poem, [scansion], generation), [])
+        self.assertEqual(PoemScansion.objects.get(pk=scansion.pk).generation, generation)
+
+    def test_refresh_scansions_changed_words(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        self.assertEqual(scansion.scansion, "u / ?? ")
+        record("squirrel", "/u")
+        generation = sync_lexicon()
+        scansion = PoemScansion.objects.select_related("type").get(pk=scansion.pk)
+        self.assertEqual(refresh_scansions(self.poem.poem, [scansion], generation), [scansion])
+        scansion.refresh_from_db()
+        self.assertEqual((scansion.scansion, scansion.generation), ("u / /u ", generation))
+
+    def test_refresh_word_stats_batches(self):
+        words = [f"word{letter}" for letter in "abcde"]
+        Pronunciation.objects.bulk_create([Pronunciation(word=word, stresses="/", popularity=1)
+                                           for word in words])
+        with mock.patch("app.scan.LOOKUP_BATCH_SIZE", 2):
+            with CaptureQueriesContext(connection) as captured:
+                refresh_word_stats(words)
+            self.assertEqual(WordStats.objects.filter(word__in=words).count(), 5)
+            # one existing-row lookup per batch of two words
+            self.assertEqual(len([query for query in captured.captured_queries
+                                  if query["sql"].startswith('SELECT "app_wordstats"')]), 3)
+            Pronunciation.objects.filter(word__in=words[1:]).delete()
+            refresh_word_stats(words)
+        self.assertEqual(list(WordStats.objects.filter(word__in=words)
+                              .values_list("word", flat=True)), ["worda"])
+
+    def test_sync_lexicon_other_process(self):
+        sync_lexicon()
+        self.assertEqual(get_stats("water"), [6.0, 0.0333])
+        # another process changes water's patterns (queryset updates bypass
+        # this process's caches)
+        Pronunciation.objects.filter(word="water").update(stresses="u/")
+        with transaction.atomic():
+            refresh_word_stats(["water"], bump_generation())
+        self.assertEqual(get_stats("water"), [6.0, 0.0333])
+        sync_lexicon()
+        self.assertEqual(get_stats("water"), [0.0333, 6.0])
+
+    def test_sweep_scansions(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        other = Poem.objects.create(poem="water the moon")
+        unchanged = PoemScansion.objects.create(poem=other, type=self.algorithm,
+                                                scansion="/u u / ",
+                                                generation=scansion.generation)
+        record("squirrel", "/u")
+        out = StringIO()
+        call_command("sweep_scansions", chunk_size=1, stdout=out)
+        # only the poem with squirrel(s) in it is checked
+        self.assertIn("Checked 1 scansions", out.getvalue())
+        self.assertIn("rescanned 1", out.getvalue())
+        scansion.refresh_from_db()
+        unchanged.refresh_from_db()
+        self.assertEqual(scansion.scansion, "u / /u ")
+        self.assertEqual(unchanged.generation, lexicon_generation())
+        out = StringIO()
+        call_command("sweep_scansions", stdout=out)
+        self.assertIn("Checked 0 scansions", out.getvalue())
+        self.assertEqual(LexiconState.objects.get().swept_generation, lexicon_generation())
+
+    def test_sweep_scansions_older_than_swept(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        record("squirrel", "/u")
+        # a sweep already ran past squirrel's change before the scansion,
+        # scanned earlier, was stored
+        LexiconState.objects.filter(pk=1).update(swept_generation=lexicon_generation())
+        out = StringIO()
+        call_command("sweep_scansions", stdout=out)
+        self.assertIn("rescanned 1", out.getvalue())
+        scansion.refresh_from_db()
+        self.assertEqual(scansion.scansion, "u / /u ")
+
+    def test_sweep_scansions_unindexed_poem(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        # as for a poem loaded from a fixture and never indexed
+        WordOccurrence.objects.filter(poem=self.poem).delete()
+        record("squirrel", "/u")
+        self.assertEqual(list(changed_poem_ids(scansion.generation, lexicon_generation())),
+                         [self.poem.pk])
+        out = StringIO()
+        call_command("sweep_scansions", stdout=out)
+        self.assertIn("rescanned 1", out.getvalue())
+        scansion.refresh_from_db()
+        self.assertEqual(scansion.scansion, "u / /u ")
+
+    def test_sweep_scansions_all(self):
+        scansion = self.stored_scansion(self.poem.poem)
+        other = Poem.objects.create(poem="water the moon")
+        PoemScansion.objects.create(poem=other, type=self.algorithm, scansion="/u u / ",
+                                    generation=scansion.generation)
+        record("squirrel", "/u")
+        out = StringIO()
+        call_command("sweep_scansions", "--all", stdout=out)
+        self.assertIn("Checked 2 scansions", out.getvalue())
+        self.assertIn("rescanned 1", out.getvalue())
+
+    def test_poem_words(self):
+        self.assertEqual(poem_words("The moons,\nthe moons--"),
+                         {"the", "moons", "moon", "moone"})
+
+    def test_index_poem(self):
+        self.assertEqual(set(WordOccurrence.objects.filter(poem=self.poem)
+                             .values_list("word", flat=True)),
+                         poem_words("the moon squirrels"))
+        self.poem.poem = "the moon"
+        self.poem.save()
+        self.assertEqual(set(WordOccurrence.objects.filter(poem=self.poem)
+                             .values_list("word", flat=True)), {"the", "moon"})
+        with self.assertNumQueries(1):
+            index_poem(self.poem)
+        record("moon", "/")
+        self.assertEqual(list(changed_poem_ids(0, lexicon_generation())), [self.poem.pk])
+        self.assertEqual(list(changed_poem_ids(lexicon_generation(), lexicon_generation())), [])
+
+
+class TestHouseRobberLine(SimpleTestCase):
+    def test_matches_quadratic(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            line = random_line(rng, rng.randint(0, 30))
+            self.assertEqual(house_robber_line(line),
+                             quadratic_house_robber_line(line))
+
+    @tag("slow")
+    def test_large_line_benchmark(self):
+        line = random_line(random.Random(1), 1500)
+        start = time.perf_counter()
+        linear = house_robber_line(line)
+        linear_time = time.perf_counter() - start
+        start = time.perf_counter()
+        quadratic = quadratic_house_robber_line(line)
+        quadratic_time = time.perf_counter() - start
+        self.assertEqual(linear, quadratic)
+        self.assertLess(linear_time * 10, quadratic_time)
@@ -0,0 +1,54 @@
+import random
+from unittest import skipIf
+from django.test import TestCase
+from app import scan, vectorized
+from app.models import Pronunciation
+
+WORDS = {"the": [("u", 381), ("/", 4)],
+         "moon": [("u", 1), ("/", 15)],
+         "is": [("u", 89), ("/", 29)],
+         "water": [("/u", 3)],
+         "quietness": [("/uu", 1), ("/u/", 1)],
+         "an": [("u", 11)],
+         "beloved": [("u/", 1), ("u/u", 1)]}
+
+
+@skipIf(vectorized.np is None, "NumPy is not installed")
+class TestVectorized(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for word, patterns in WORDS.items():
+            for stresses, popularity in patterns:
+                Pronunciation.objects.create(word=word, stresses=stresses,
+                                             popularity=popularity)
+
+    def setUp(self):
+        scan.clear_caches()
+
+    def test_poem_arrays(self):
+        arrays = vectorized.poem_arrays([[0.5, " ", 2.0, "?", " "], [], [1.0, " "]])
+        self.assertEqual(arrays.values[:2].tolist(), [0.5, 2.0])
+        self.assertTrue(vectorized.np.isnan(arrays.values[2]))
+        self.assertEqual(arrays.word_end.tolist(), [True, False, True, True])
+        self.assertEqual(arrays.line_offsets.tolist(), [0, 3, 3, 4])
+
+    def test_examples(self):
+        self.assertEqual(vectorized.original_scan("water moon"), "/u / ")
+        self.assertEqual(vectorized.original_scan("is is"), "? ? ")
+        self.assertEqual(vectorized.original_scan("the squirrel"), "u ?? ")
+        self.assertEqual(vectorized.original_scan("the moon is\nthe squirrel"),
+                         "u / u \nu ?? ")
+        self.assertEqual(vectorized.prose_scan("water the squirrel"), "/u u ?? ")
+        self.assertEqual(vectorized.prose_scan(""), "")
+
+    def test_matches_scan(self):
+        rng = random.Random(0)
+        vocabulary = list(WORDS) + ["squirrel", "bird", "Moon,", "--"]
+        for _ in range(100):
+            lines = []
+            for _ in range(rng.randint(1, 6)):
+                words = rng.randint(0, 12)
+                lines.append(" ".join(rng.choice(vocabulary) for _ in range(words)))
+            poem = "\n".join(lines)
+            self.assertEqual(vectorized.original_scan(poem), scan.original_scan(poem))
+            self.assertEqual(vectorized.prose_scan(poem), scan.prose_scan(poem))
@@ -1,8 +1,20 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlencode
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, connection, transaction
 from django.test import TestCase
+from unittest import mock
+from django.test.utils import CaptureQueriesContext
 from django.test import Client
 from django.urls import reverse
-from app.views import index, about, import_poem, poem, choose_poem, automated, own_poem
-from app.models import User, Pronunciation, Poem, Algorithm, PoemScansion
+from app.views import index, about, import_poem, poem, choose_poem, automated, own_poem, offload, scan_executor
+from app.views import automated_prepare, automated_save
+from app.models import User, Pronunciation, Poem, Algorithm, PoemScansion, WordStats
+from app.listing import poem_listing
+from app import scan
 
 client = Client()
 
@@ -91,6 +103,9 @@ class TestImportPoem(TestCase):
                                  function_name="house_robber_scan",
                                  preferred=True)
 
+    def setUp(self):
+        scan.clear_caches()
+
     def test_get_import_poem_not_authenticated(self):
         response = self.client.get(reverse("import_poem"))
         self.assertEqual(response.status_code, 302)
@@ -144,6 +159,10 @@ class TestChoosePoem(TestCase):
         Poem.objects.create(poem="moon squirrel")
         Poem.objects.create(poem="squirrel moon", human_scanned=True)
         Poem.objects.create(poem="The moon is a wavering rim where one fish slips.")
+        User.objects.create_user("someone", password="12345", points=10, promoted=True)
+
+    def setUp(self):
+        poem_listing.invalidate()
 
     def test_choose_poem(self):
         response = self.client.get(reverse("choose_poem"))
@@ -152,9 +171,54 @@ class TestChoosePoem(TestCase):
         self.assertQuerysetEqual(response.context[0]["human_list"],
                                  Poem.objects.filter(poem="squirrel moon"),
                                  transform=lambda x: x)
+        # only promoted users see poems to correct
+        self.assertIsNone(response.context[0]["computer_list"])
+
+    def test_choose_poem_promoted(self):
+        self.client.login(username="someone", password="12345")
+        response = self.client.get(reverse("choose_poem"))
         self.assertQuerysetEqual(response.context[0]["computer_list"],
-                                 Poem.objects.filter(human_scanned=False),
+                                 Poem.objects.filter(human_scanned=False).order_by("poet", "id"),
                                  transform=lambda x: x)
+        # with only the listed fields loaded
+        self.assertEqual(response.context[0]["computer_list"].poems[0].get_deferred_fields(),
+                         {"poem", "scansion", "human_scanned"})
+
+    def test_choose_poem_pages(self):
+        for i in range(3):
+            Poem.objects.create(poem=f"poem {i}", poet=f"Poet {i}", human_scanned=True)
+        poem_listing.per_page = 2
+        self.addCleanup(setattr, poem_listing, "per_page", 100)
+        response = self.client.get(reverse("choose_poem"), {"human_page": 2})
+        page = response.context[0]["human_list"]
+        self.assertEqual((page.number, page.num_pages, page.count), (2, 2, 4))
+        self.assertEqual([poem.poet for poem in page], ["Poet 1", "Poet 2"])
+        self.assertContains(response, "?human_page=1")
+        # out of range pages give the last page
+        response = self.client.get(reverse("choose_poem"), {"human_page": 9})
+        self.assertEqual(response.context[0]["human_list"].number, 2)
+
+    def test_choose_poem_cached(self):
+        self.client.get(reverse("choose_poem"))
+        with self.assertNumQueries(0):
+            self.client.get(reverse("choose_poem"))
+        # saving only the scansion keeps the cached page
+        Poem.objects.filter(human_scanned=True).first().save(update_fields=["scansion"])
+        with self.assertNumQueries(0):
+            self.client.get(reverse("choose_poem"))
+        # but a newly scanned poem is listed
+        Poem.objects.create(poem="moon moon", title="Moons", human_scanned=True)
+        response = self.client.get(reverse("choose_poem"))
+        self.assertContains(response, "Moons")
+
+    def test_choose_poem_cache_keys(self):
+        self.client.get(reverse("choose_poem"))
+        # junk and out of range page numbers reuse the cached pages
+        with self.assertNumQueries(0):
+            for number in ["x", "", "1", "01", "-3", "999", "1e3"]:
+                response = self.client.get(reverse("choose_poem"), {"human_page": number})
+                self.assertEqual(response.context[0]["human_list"].number, 1)
+        self.assertEqual(list(poem_listing.pages), [(True, 1)])
 
 class TestAutomated(TestCase):
     @classmethod
@@ -170,6 +234,9 @@ class TestAutomated(TestCase):
                                  function_name="house_robber_scan",
                                  preferred=True)
 
+    def setUp(self):
+        scan.clear_caches()
+
     def test_automated_no_id(self):
         line = "The moon is a wavering rim where one fish slips."
         house_robber_scansions = {"moon squirrel": "/ u/ ",
@@ -202,6 +269,43 @@ class TestAutomated(TestCase):
         self.assertEqual(response.context[0]["scansions"][0].scansion,
                          "/ u/ ")
 
+    def test_automated_rescans_stale(self):
+        poem = Poem.objects.get(poem="moon squirrel")
+        for algorithm in Algorithm.objects.order_by("-preferred"):
+            PoemScansion.objects.create(poem=poem, type=algorithm, scansion="stale")
+        scan.record("squirrel", "u/")
+        response = self.client.get(reverse("automated", kwargs={"id": poem.pk}))
+        self.assertEqual(response.context[0]["scansions"][0].scansion,
+                         scan.house_robber_scan("moon squirrel"))
+        self.assertFalse(PoemScansion.objects.filter(scansion="stale").exists())
+        self.assertEqual(set(PoemScansion.objects.values_list("generation", flat=True)),
+                         {scan.lexicon_generation()})
+
+    def test_automated_scanned_read_only(self):
+        poem = Poem.objects.get(poem="moon squirrel")
+        self.client.get(reverse("automated", kwargs={"id": poem.pk}))
+        self.assertEqual(PoemScansion.objects.filter(poem=poem).count(), 2)
+        self.assertEqual(Poem.objects.get(pk=poem.pk).scansion, "/ u/ ")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("automated", kwargs={"id": poem.pk}))
+        self.assertFalse([query["sql"] for query in queries.captured_queries
+                          if not query["sql"].startswith("SELECT")])
+        # scansions come in the order of the algorithms, preferred first
+        self.assertEqual([s.type.function_name for s in response.context[0]["scansions"]],
+                         ["house_robber_scan", "original_scan"])
+
+    def test_automated_concurrent_insert(self):
+        poem = Poem.objects.get(poem="moon squirrel")
+        algorithm = Algorithm.objects.get(function_name="original_scan")
+        # another request stores a scansion after this one found it missing
+        poem, algorithms, stored, missing, names, generation, lexicon = automated_prepare(poem.pk)
+        PoemScansion.objects.create(poem=poem, type=algorithm, scansion="? ?? ")
+        results = scan.scan_all(poem.poem, names, lexicon=lexicon)
+        automated_save(poem, algorithms, stored, missing, results, generation)
+        self.assertEqual(PoemScansion.objects.filter(poem=poem, type=algorithm).count(), 1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PoemScansion.objects.create(poem=poem, type=algorithm, scansion="? ?? ")
+
 class TestOwnPoem(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -213,6 +317,9 @@ class TestOwnPoem(TestCase):
                                  function_name="house_robber_scan",
                                  preferred=True)
 
+    def setUp(self):
+        scan.clear_caches()
+
     def test_own_poem_get(self):
         response = self.client.get(reverse("own_poem"))
         self.assertEqual(response.status_code, 200)
@@ -232,3 +339,192 @@ class TestOwnPoem(TestCase):
                          "? ?? ")
         self.assertEqual(response.context[0]["algorithms"][0].function_name,
                          "house_robber_scan")
+
+class TestApiScan(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        Pronunciation.objects.create(word="moon", stresses="u", popularity=1)
+        Algorithm.objects.create(name="Original Scan",
+                                 about="words",
+                                 function_name="original_scan")
+        Algorithm.objects.create(name="House Robber Scan",
+                                 about="words",
+                                 function_name="house_robber_scan",
+                                 preferred=True)
+
+    def setUp(self):
+        scan.clear_caches()
+
+    def post(self, data):
+        return self.client.post(reverse("api_scan"), json.dumps(data),
+                                content_type="application/json")
+
+    def test_api_scan(self):
+        poems = ["moon squirrel", "Squirrel,\nmoon"]
+        response = self.post({"poems": poems})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["algorithms"], ["house_robber_scan", "original_scan"])
+        self.assertEqual(data["results"],
+                         [{"scansions": scan.scan_all(poem, data["algorithms"])}
+                          for poem in poems])
+
+    def test_api_scan_stats(self):
+        response = self.post({"poems": ["moon squirrel"], "algorithms": ["prose_scan"],
+                              "stats": True, "confidence": True})
+        result = response.json()["results"][0]
+        self.assertEqual(result["scansions"], {"prose_scan": "/ ?? "})
+        self.assertEqual(result["stats"], [[[14.8515], ["?", "?"]]])
+        self.assertEqual(result["confidence"], [[16, 0]])
+
+    def test_api_scan_one_lookup(self):
+        # the words of the whole batch are looked up together
+        scan.known_words()
+        # (the lexicon generation, then the stats of the batch's words)
+        with self.assertNumQueries(3):
+            response = self.post({"poems": ["moon squirrel", "squirrel moon", "moon"] * 5,
+                                  "algorithms": ["house_robber_scan"]})
+        self.assertEqual(len(response.json()["results"]), 15)
+
+    def test_api_scan_other_process(self):
+        data = {"poems": ["moon"], "algorithms": ["prose_scan"], "stats": True}
+        before = self.post(data).json()["results"][0]["stats"]
+        # another process records moon (queryset updates bypass this
+        # process's caches)
+        Pronunciation.objects.filter(word="moon", stresses="u").update(popularity=30)
+        with transaction.atomic():
+            scan.refresh_word_stats(["moon"], scan.bump_generation())
+        after = self.post(data).json()["results"][0]["stats"]
+        self.assertNotEqual(after, before)
+        scan.clear_caches()
+        self.assertEqual(after, [[scan.get_stats("moon")]])
+
+    def test_api_scan_errors(self):
+        for data, message in [([], "JSON object"),
+                              ({"poems": "moon"}, "list of strings"),
+                              ({"poems": ["moon"], "algorithms": ["nope"]}, "nope"),
+                              ({"poems": ["moon"] * 101}, "At most 100")]:
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(message, response.json()["error"])
+        response = self.client.post(reverse("api_scan"), "{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse("api_scan")).status_code, 405)
+
+class TestAsyncViews(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Pronunciation.objects.create(word="moon", stresses="/", popularity=15)
+        Pronunciation.objects.create(word="moon", stresses="u", popularity=1)
+        cls.poem = Poem.objects.create(poem="moon squirrel")
+        Algorithm.objects.create(name="Original Scan",
+                                 about="words",
+                                 function_name="original_scan")
+        Algorithm.objects.create(name="House Robber Scan",
+                                 about="words",
+                                 function_name="house_robber_scan",
+                                 preferred=True)
+
+    def setUp(self):
+        scan.clear_caches()
+
+    async def test_own_poem_async(self):
+        response = await self.async_client.get(reverse("own_poem_async"))
+        self.assertEqual(response.templates[0].name, "app/own_poem.html")
+        # (the async test client of this Django version cannot send multipart)
+        response = await self.async_client.post(reverse("own_poem_async"),
+                                                urlencode({"title": "",
+                                                           "poem": "moon squirrel",
+                                                           "poet": "Moon Squirrel"}),
+                                                content_type="application/x-www-form-urlencoded")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.templates[0].name, "app/automated.html")
+        self.assertEqual([s.scansion for s in response.context[0]["scansions"]],
+                         ["/ u/ ", "/ ?? "])
+
+    async def test_automated_async(self):
+        response = await self.async_client.get(reverse("automated_async",
+                                                       kwargs={"id": self.poem.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context[0]["poem"].scansion, "/ u/ ")
+        count = sync_to_async(PoemScansion.objects.filter(poem=self.poem).count)
+        self.assertEqual(await count(), 2)
+
+    async def test_automated_async_rescans_in_executor(self):
+        url = reverse("automated_async", kwargs={"id": self.poem.pk})
+        await self.async_client.get(url)
+        await sync_to_async(scan.record)("squirrel", "/u")
+        threads = []
+        def scanned_on(function):
+            def run(poem, stress_list):
+                threads.append(threading.current_thread().name)
+                return function(poem, stress_list=stress_list)
+            return run
+        with mock.patch.dict(scan.SCANS, {name: scanned_on(function)
+                                          for name, function in scan.SCANS.items()}):
+            response = await self.async_client.get(url)
+        # the outdated scansions are rescanned, on scan_executor's threads
+        self.assertEqual([s.scansion for s in response.context[0]["scansions"]],
+                         ["/ u/ ", "/ /u "])
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith("scan") for name in threads))
+
+    async def test_api_scan_async(self):
+        response = await self.async_client.post(reverse("api_scan_async"),
+                                                json.dumps({"poems": ["moon squirrel"],
+                                                            "algorithms": ["prose_scan"],
+                                                            "confidence": True}),
+                                                content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"],
+                         [{"scansions": {"prose_scan": "/ ?? "}, "confidence": [[16, 0]]}])
+        response = await self.async_client.post(reverse("api_scan_async"),
+                                                json.dumps({"poems": ["moon"], "algorithms": ["x"]}),
+                                                content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    async def test_scans_capped(self):
+        # scans beyond the cap wait for a free thread instead of running
+        running = []
+        peak = []
+        def slow_scan(poem):
+            running.append(poem)
+            peak.append(len(running))
+            time.sleep(0.01)
+            running.remove(poem)
+            return poem
+        results = await asyncio.gather(*[offload(slow_scan, i) for i in range(12)])
+        self.assertEqual(results, list(range(12)))
+        self.assertLessEqual(max(peak), scan_executor._max_workers)
+
+
+class TestPronunciationAdmin(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_superuser("someone", password="12345")
+        cls.moon = Pronunciation.objects.create(word="moon", stresses="/", popularity=1)
+
+    def setUp(self):
+        scan.clear_caches()
+        self.client.login(username="someone", password="12345")
+
+    def test_edit_updates_word_stats(self):
+        self.assertEqual(scan.get_stats("moon"), [2.0])
+        generation = scan.lexicon_generation()
+        url = reverse("admin:app_pronunciation_change", args=[self.moon.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {"word": "moon", "stresses": "/", "popularity": 3})
+        self.assertEqual(response.status_code, 302)
+        stats = WordStats.objects.get(word="moon")
+        self.assertEqual((stats.ratios, stats.generation), ([6.0], generation + 1))
+        # and the stats cached before the edit are dropped
+        self.assertEqual(scan.get_stats("moon"), [6.0])
+
+    def test_delete_updates_word_stats(self):
+        scan.get_stats("moon")
+        url = reverse("admin:app_pronunciation_delete", args=[self.moon.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {"post": "yes"})
+        self.assertFalse(WordStats.objects.filter(word="moon").exists())
+        self.assertEqual(scan.get_stats("moon"), ["?"])
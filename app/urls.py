@@ -14,5 +14,11 @@ urlpatterns = [
     path("choose_poem", views.choose_poem, name="choose_poem"),
     path("automated", views.automated, name="automated"),
     path("automated/<int:id>", views.automated, name="automated"),
-    path("own_poem", views.own_poem, name="own_poem")
+    path("own_poem", views.own_poem, name="own_poem"),
+    path("api/scan", views.api_scan, name="api_scan"),
+    path("metrics", views.prometheus_metrics, name="metrics"),
+    path("async/automated", views.automated_async, name="automated_async"),
+    path("async/automated/<int:id>", views.automated_async, name="automated_async"),
+    path("async/own_poem", views.own_poem_async, name="own_poem_async"),
+    path("async/api/scan", views.api_scan_async, name="api_scan_async")
 ]
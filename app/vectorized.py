@@ -0,0 +1,172 @@
+"""MODULE VECTORIZED
+=====================
+This module reimplements the comparison-free scans of `scan.py` with
+NumPy array operations over a whole poem at once. NumPy is optional;
+`np` is None when it is not installed.
+
+A poem is flattened into a `PoemArrays`: one float per syllable (NaN
+where the stress is unknown), a flag marking the last syllable of each
+word and the syllable offset at which each line starts.
+
+Functions
+---------
+
+poem_arrays(stress_list) : Flatten poem_stats output into arrays.
+render(symbols, arrays) : Join per-syllable symbols into a scansion.
+original_scan(poem, stress_list=None) : Vectorized scan.original_scan.
+prose_scan(poem, stress_list=None) : Vectorized scan.prose_scan.
+"""
+
+
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# values : float array, word_end : bool array, line_offsets : int array
+# with one more entry than there are lines
+PoemArrays = namedtuple("PoemArrays", ["values", "word_end", "line_offsets"])
+
+def require_numpy():
+    """Raise ImportError if NumPy is not installed."""
+    if np is None:
+        raise ImportError("NumPy is required for the vectorized scansion engine.")
+
+def poem_arrays(stress_list):
+    """Flatten poem_stats output into arrays.
+
+    Parameters
+    ----------
+    stress_list : list
+        list of lists of stress ratios as returned by `scan.poem_stats`
+
+    Returns
+    -------
+    arrays : PoemArrays
+        syllable values with NaN for `?`, word-end flags and line offsets
+    """
+    require_numpy()
+    values = []
+    word_end = []
+    line_offsets = [0]
+    for line in stress_list:
+        for value in line:
+            # a space closes the word whose syllables precede it
+            if value == " ":
+                word_end[-1] = True
+            else:
+                values.append(float("nan") if value == "?" else value)
+                word_end.append(False)
+        line_offsets.append(len(values))
+    return PoemArrays(np.array(values, dtype=np.float64),
+                      np.array(word_end, dtype=bool),
+                      np.array(line_offsets, dtype=np.intp))
+
+def render(symbols, arrays):
+    """Join per-syllable symbols into a scansion string.
+
+    Parameters
+    ----------
+    symbols : numpy.ndarray
+        one single-character string per syllable
+
+    arrays : PoemArrays
+        the arrays the symbols were computed from
+
+    Returns
+    -------
+    scansion : str
+        scansion with lines separated by newlines, words by spaces
+    """
+    word_end = arrays.word_end
+    line_offsets = arrays.line_offsets
+    count = len(symbols)
+    lines = len(line_offsets) - 1
+    # words_before[i] is the number of words that end before syllable i
+    words_before = np.zeros(count + 1, dtype=np.intp)
+    np.cumsum(word_end, out=words_before[1:])
+    # each syllable moves right by one for every space and newline before it
+    line_of = np.repeat(np.arange(lines), np.diff(line_offsets))
+    positions = np.arange(count) + words_before[:-1] + line_of
+    out = np.full(count + int(words_before[-1]) + lines - 1, " ", dtype="<U1")
+    out[positions] = symbols
+    # spaces are already in place after word ends; add the newlines
+    breaks = line_offsets[1:-1]
+    out[breaks + words_before[breaks] + np.arange(lines - 1)] = "\n"
+    return "".join(out.tolist())
+
+def original_scan(poem, stress_list=None):
+    """Scan poem by comparing each stress ratio to the next, vectorized.
+
+    Gives the same result as `scan.original_scan`: each syllable is
+    compared to the next one in its line, the last syllable of a line
+    to the previous one, and a lone syllable to itself.
+
+    Parameters
+    ----------
+    poem : str
+        poem to scan
+
+    stress_list : list, optional
+        poem_stats(poem), if it has already been computed
+
+    Returns
+    -------
+    poem_scansion : str
+        scansion with lines separated by newlines, words by spaces
+    """
+    require_numpy()
+    if stress_list is None:
+        from .scan import poem_stats
+        stress_list = poem_stats(poem)
+    arrays = poem_arrays(stress_list)
+    values = arrays.values
+    starts = arrays.line_offsets[:-1]
+    ends = arrays.line_offsets[1:]
+    nonempty = ends > starts
+    index = np.arange(len(values))
+    is_first = np.zeros(len(values), dtype=bool)
+    is_first[starts[nonempty]] = True
+    is_last = np.zeros(len(values), dtype=bool)
+    is_last[ends[nonempty] - 1] = True
+    # compare to the next syllable, or the previous one at the end of a line
+    neighbor = np.where(is_last, np.where(is_first, index, index - 1), index + 1)
+    other = values[neighbor] if len(values) else values
+    known = ~np.isnan(values)
+    other_unknown = np.isnan(other)
+    symbols = np.full(len(values), "?", dtype="<U1")
+    # if the neighbor is unknown, guess from the syllable's own ratio
+    symbols[known & other_unknown & (values < 0.2)] = "u"
+    symbols[known & other_unknown & (values >= 1.0)] = "/"
+    # otherwise the smaller of the two is unstressed, the larger stressed
+    symbols[known & ~other_unknown & (values < other)] = "u"
+    symbols[known & ~other_unknown & (values > other)] = "/"
+    return render(symbols, arrays)
+
+def prose_scan(poem, stress_list=None):
+    """Scan poem using ratios but not comparing them, vectorized.
+
+    Parameters
+    ----------
+    poem : str
+        poem to scan
+
+    stress_list : list, optional
+        poem_stats(poem), if it has already been computed
+
+    Returns
+    -------
+    poem_scansion : str
+        scansion with lines separated by newlines, words by spaces
+    """
+    require_numpy()
+    if stress_list is None:
+        from .scan import poem_stats
+        stress_list = poem_stats(poem)
+    arrays = poem_arrays(stress_list)
+    values = arrays.values
+    symbols = np.where(values > 1, "/", "u")
+    symbols[np.isnan(values)] = "?"
+    return render(symbols, arrays)
@@ -1,5 +1,6 @@
 from django.shortcuts import HttpResponseRedirect, render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.conf import settings
 from django.urls import reverse
 # https://www.kite.com/python/docs/django.contrib.admindocs.views.staff_member_required
 from django.contrib.admin.views.decorators import staff_member_required
@@ -7,13 +8,19 @@ from django.contrib.auth import authenticate, login, logout
 from django.db.models import Max
 from django.views.decorators.csrf import csrf_exempt
 from django.template.defaulttags import register
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
 import random
 import json
 
 from .models import User, Pronunciation, Poem, Algorithm, PoemScansion
-from . import scan
+from .listing import poem_listing
+from .picker import poem_picker
+from . import metrics, scan
 
-SCANS = {"house_robber_scan": scan.house_robber_scan, "original_scan": scan.original_scan, "prose_scan": scan.prose_scan}
+SCANS = scan.SCANS
 
 # Create your views here.
 def index(request):
@@ -47,16 +54,14 @@ def index(request):
     else:
         # if user is logged in, respond to GET request with a random poem
         if request.user.is_authenticated and request.user.promoted:
-            # https://books.agiliq.com/projects/django-orm-cookbook/en/latest/random.html
             # if user is promoted, choose poem from all poems
-            poem = Poem.objects.all().order_by("?").first()
+            # (picked from cached ids rather than sorting the table randomly)
+            poem = poem_picker.random_poem()
         else:
             # otherwise, whether user logged in or not display poem
             # chosen from only human-scanned poems
-            poems = Poem.objects.filter(human_scanned=True).order_by("?")
-            if poems.exists():
-                poem = poems.first()
-            else:
+            poem = poem_picker.random_poem(human_scanned=True)
+            if poem is None:
                 tempestuous = """Full fathom five thy father lies:
 Of his bones are coral made;
 Those are pearls that were his eyes:
@@ -150,7 +155,10 @@ def import_poem(request):
         poem = request.POST["poem"]
         poet = request.POST["poet"]
         # human_scanned = False
-        scansion = scan.house_robber_scan(poem)
+        # (scan_all serves poems that were scanned before from its cache,
+        # once stats recorded by other processes have been dropped from it)
+        scan.sync_lexicon()
+        scansion = scan.scan_all(poem, ["house_robber_scan"])["house_robber_scan"]
         # if poem already in database, overwrite it
         p = Poem.objects.filter(poem=poem)
         if p.exists():
@@ -170,9 +178,14 @@ def import_poem(request):
         return render(request, "app/import_poem.html")
 
 def choose_poem(request):
-    # allow user to choose a poem to scan
-    human_list = Poem.objects.filter(human_scanned=True).order_by("poet")
-    computer_list = Poem.objects.filter(human_scanned=False).order_by("poet")
+    # allow user to choose a poem to scan, a page of titles and poets at a time
+    # (the pages are cached until poems are imported or scanned by users)
+    human_list = poem_listing.page(True, request.GET.get("human_page", 1))
+    # only promoted users are shown poems to correct
+    if request.user.is_authenticated and request.user.promoted:
+        computer_list = poem_listing.page(False, request.GET.get("computer_page", 1))
+    else:
+        computer_list = None
     return render(request, "app/choose_poem.html", {"human_list": human_list, "computer_list": computer_list})
 
 def poem(request, id):
@@ -180,21 +193,70 @@ def poem(request, id):
     poem = Poem.objects.get(pk=id)
     return render(request, "app/index.html", {"poem": poem })
 
-def automated(request, id=''):
+def prometheus_metrics(request):
+    # timings and word counts of the scan pipeline in this process, for
+    # Prometheus to scrape (see metrics.py)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def batch_lexicon(poems, sync=True):
+    # tokenize poems and look up every distinct word in them at once, first
+    # dropping stats this process cached for words recorded elsewhere
+    # (unless the caller just did)
+    if sync:
+        scan.sync_lexicon()
+    tokenized = [scan.tokenize(poem) for poem in poems]
+    lexicon = scan.lexicon_stats(token.norm for lines in tokenized
+                                 for tokens in lines for token in tokens)
+    return tokenized, lexicon
+
+def automated_prepare(id):
+    # the database work automated does before scanning: find the poem, the
+    # algorithms it has no scansion for yet, the names of those and of the
+    # algorithms whose stored scansion is out of date, and the stats to
+    # scan it with
     if id:
         poem = Poem.objects.get(pk=id)
     else:
-        poem = Poem.objects.all().order_by("?").first()
-    algorithms = Algorithm.objects.all().order_by("-preferred")
-    for algorithm in algorithms:
-        if not PoemScansion.objects.filter(poem=poem, type=algorithm):
-            s = PoemScansion(poem=poem,
-                             scansion=SCANS[algorithm.function_name](poem.poem),
-                             type=algorithm)
-            s.save()
-    scansions = PoemScansion.objects.filter(poem=poem)
-    poem.scansion = scansions[0].scansion
-    poem.save()
+        poem = poem_picker.random_poem()
+    algorithms = list(Algorithm.objects.all().order_by("-preferred"))
+    # drop stats this process cached for words recorded elsewhere
+    generation = scan.sync_lexicon()
+    # the poem's stored scansions by algorithm, in one query
+    stored = {s.type_id: s for s in PoemScansion.objects.filter(poem=poem).select_related("type")}
+    missing = [algorithm for algorithm in algorithms if algorithm.pk not in stored]
+    stale = scan.stale_scansions(poem.poem, stored.values(), generation)
+    names = sorted({algorithm.function_name for algorithm in missing}
+                   | {s.type.function_name for s in stale})
+    lexicon = batch_lexicon([poem.poem], sync=False)[1] if names else None
+    return poem, algorithms, stored, missing, names, generation, lexicon
+
+def automated_save(poem, algorithms, stored, missing, results, generation):
+    # and the database work after: save the new scansions and return them all
+    # in the order of algorithms, writing nothing if nothing changed
+    new = {algorithm.pk: PoemScansion(poem=poem,
+                                      scansion=results[algorithm.function_name],
+                                      type=algorithm,
+                                      generation=generation)
+           for algorithm in missing}
+    if new:
+        # a concurrent request may have stored the same scansions already
+        PoemScansion.objects.bulk_create(new.values(), ignore_conflicts=True)
+    # update stored scansions if words of the poem were recorded since
+    # (with the results scanned for them, so no scan runs here)
+    scan.refresh_scansions(poem.poem, stored.values(), generation, results=results)
+    scansions = [stored.get(algorithm.pk) or new[algorithm.pk] for algorithm in algorithms]
+    # keep the preferred algorithm's scansion on the poem
+    if scansions and poem.scansion != scansions[0].scansion:
+        poem.scansion = scansions[0].scansion
+        # (saving only the scansion keeps the choose_poem pages cached)
+        poem.save(update_fields=["scansion"])
+    return scansions
+
+def automated(request, id=''):
+    poem, algorithms, stored, missing, names, generation, lexicon = automated_prepare(id)
+    # run every missing or outdated algorithm off a single lexicon lookup
+    results = scan.scan_all(poem.poem, names, lexicon=lexicon)
+    scansions = automated_save(poem, algorithms, stored, missing, results, generation)
     return render(request, "app/automated.html", {
     "poem": poem, "scansions": scansions, "algorithms": algorithms
     })
@@ -206,10 +268,12 @@ def own_poem(request):
         poem = request.POST["poem"]
         poet = request.POST["poet"]
         p = Poem(title=title, poem=poem, poet=poet)
+        scan.sync_lexicon()
+        results = scan.scan_all(poem, [algorithm.function_name for algorithm in algorithms])
         scansions = []
         for algorithm in algorithms:
             scansions.append(PoemScansion(poem=p,
-                             scansion=SCANS[algorithm.function_name](poem),
+                             scansion=results[algorithm.function_name],
                              type=algorithm))
         return render(request, "app/automated.html",
                       {"poem" : p,
@@ -217,3 +281,152 @@ def own_poem(request):
                        "algorithms": algorithms})
     else:
         return render(request, "app/own_poem.html")
+
+def api_scan_request(data):
+    """Validate a decoded /api/scan request body.
+
+    Returns
+    -------
+    poems, names : list
+        poems to scan and the function_names of the algorithms to run
+
+    Raises
+    ------
+    ValueError
+        with a message for the client if the request is invalid
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object.")
+    poems = data.get("poems")
+    if not isinstance(poems, list) or not all(isinstance(poem, str) for poem in poems):
+        raise ValueError('"poems" must be a list of strings.')
+    limit = getattr(settings, "SCAN_API_MAX_POEMS", 100)
+    if len(poems) > limit:
+        raise ValueError(f"At most {limit} poems can be scanned per request.")
+    names = data.get("algorithms")
+    if names is None:
+        names = [algorithm.function_name for algorithm in Algorithm.objects.all().order_by("-preferred")]
+    elif not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise ValueError('"algorithms" must be a list of strings.')
+    unknown = [name for name in names if name not in SCANS]
+    if unknown:
+        raise ValueError(f"Unknown algorithm(s): {', '.join(unknown)}")
+    return poems, names
+
+def api_scan_response(data, poems, names, tokenized, lexicon):
+    """Scan a validated /api/scan batch off its lexicon, without queries.
+
+    Returns
+    -------
+    response : dict
+        "algorithms" run and one result per poem, in order
+    """
+    results = []
+    for poem, lines in zip(poems, tokenized):
+        result = {"scansions": scan.scan_all(poem, names, lexicon=lexicon)}
+        # per line, per word, like the scansion itself
+        if data.get("stats"):
+            result["stats"] = [[lexicon[token.norm][0] for token in tokens] for tokens in lines]
+        if data.get("confidence"):
+            result["confidence"] = [[lexicon[token.norm][1] for token in tokens] for tokens in lines]
+        results.append(result)
+    return {"algorithms": names, "results": results}
+
+def api_scan_results(data):
+    """Scan the batch of poems in a decoded /api/scan request body.
+
+    Parameters
+    ----------
+    data : dict
+        "poems": list of poems; "algorithms" (optional): list of
+        Algorithm function_names, by default all of them; "stats" and
+        "confidence" (optional): whether to include each word's ratios
+        and popularity, as in `scan.get_stats(word, confidence=True)`
+
+    Returns
+    -------
+    response : dict
+        "algorithms" run and one result per poem, in order
+
+    Raises
+    ------
+    ValueError
+        with a message for the client if the request is invalid
+    """
+    poems, names = api_scan_request(data)
+    # look up every distinct word of the whole batch at once
+    tokenized, lexicon = batch_lexicon(poems)
+    return api_scan_response(data, poems, names, tokenized, lexicon)
+
+# scan a JSON batch of poems for other programs, without rendering templates
+@csrf_exempt
+def api_scan(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Request body must be valid JSON."}, status=400)
+    try:
+        return JsonResponse(api_scan_results(data))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+# async variants of the scanning views, for ASGI servers: database work
+# runs through sync_to_async, and scanning (which needs no queries once
+# the lexicon is looked up) on at most SCAN_MAX_CONCURRENT_SCANS threads,
+# so the event loop keeps serving other requests while long poems scan
+scan_executor = ThreadPoolExecutor(max_workers=getattr(settings, "SCAN_MAX_CONCURRENT_SCANS", 4),
+                                   thread_name_prefix="scan")
+
+async def offload(func, *args):
+    # run func(*args) on scan_executor; scans beyond the cap wait their turn
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(scan_executor, partial(func, *args))
+
+async def automated_async(request, id=''):
+    poem, algorithms, stored, missing, names, generation, lexicon = await sync_to_async(
+        automated_prepare)(id)
+    # outdated stored scansions are rescanned here too, within the cap
+    results = await offload(scan.scan_all, poem.poem, names, lexicon)
+    scansions = await sync_to_async(automated_save)(poem, algorithms, stored, missing,
+                                                    results, generation)
+    return await sync_to_async(render)(request, "app/automated.html", {
+    "poem": poem, "scansions": scansions, "algorithms": algorithms
+    })
+
+async def own_poem_async(request):
+    if request.method == "POST":
+        algorithms = await sync_to_async(list)(Algorithm.objects.all().order_by("-preferred"))
+        title = request.POST["title"]
+        poem = request.POST["poem"]
+        poet = request.POST["poet"]
+        p = Poem(title=title, poem=poem, poet=poet)
+        tokenized, lexicon = await sync_to_async(batch_lexicon)([poem])
+        results = await offload(scan.scan_all, poem,
+                                [algorithm.function_name for algorithm in algorithms], lexicon)
+        scansions = [PoemScansion(poem=p, scansion=results[algorithm.function_name], type=algorithm)
+                     for algorithm in algorithms]
+        return await sync_to_async(render)(request, "app/automated.html",
+                                           {"poem" : p,
+                                            "scansions": scansions,
+                                            "algorithms": algorithms})
+    else:
+        return await sync_to_async(render)(request, "app/own_poem.html")
+
+async def api_scan_async(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Only POST requests are allowed."}, status=405)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Request body must be valid JSON."}, status=400)
+    try:
+        poems, names = await sync_to_async(api_scan_request)(data)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    tokenized, lexicon = await sync_to_async(batch_lexicon)(poems)
+    return JsonResponse(await offload(api_scan_response, data, poems, names, tokenized, lexicon))
+
+# csrf_exempt does not support async views in this version of Django
+api_scan_async.csrf_exempt = True
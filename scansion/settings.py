@@ -48,6 +48,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # only installed when SCAN_QUERY_LOGGING is set
+    'app.middleware.QueryLogMiddleware',
 ]
 
 ROOT_URLCONF = 'scansion.urls'
@@ -126,3 +128,69 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Scansion
+
+# maximum number of words whose computed stress ratios are kept in memory
+SCAN_STATS_CACHE_SIZE = 10000
+
+# maximum number of out-of-lexicon words whose syllable counts are memoized
+SCAN_SYLLABLES_CACHE_SIZE = 20000
+
+# use the NumPy engine in app/vectorized.py for original_scan and prose_scan
+# (ignored if NumPy is not installed)
+SCAN_VECTORIZED = False
+
+# binary lexicon written by `manage.py compile_lexicon` and memory-mapped for
+# lookups (e.g. BASE_DIR / 'lexicon.bin'; None to always use the database),
+# and how often (in seconds) to check for words changed since it was compiled
+SCAN_LEXICON_FILE = None
+SCAN_LEXICON_STALE_CHECK = 30
+
+# derive the stress of words missing from the lexicon from their longest
+# known stem (loves from love, carried from carry) instead of marking them ?
+SCAN_STEM_FALLBACK = True
+
+# how often (in seconds) the cached ids random poems are picked from are
+# reloaded to catch poems added or changed by other processes
+SCAN_POEM_IDS_TTL = 300
+
+# poems per page of each list on the choose_poem page, and how often (in
+# seconds) cached pages are reloaded to catch poems changed by other processes
+SCAN_POEMS_PER_PAGE = 100
+SCAN_POEM_LISTING_TTL = 300
+
+# maximum number of (poem, algorithm) scansions kept in memory
+SCAN_SCANSION_CACHE_SIZE = 1000
+
+# maximum number of poems in one /api/scan request
+SCAN_API_MAX_POEMS = 100
+
+# maximum number of scans the async views run at once (more wait their turn)
+SCAN_MAX_CONCURRENT_SCANS = 4
+
+# time the stages of scanning and count scanned words, served at /metrics
+# in the Prometheus text format (see app/metrics.py)
+SCAN_METRICS = True
+
+# log the number of queries, total SQL time and slowest statements of every
+# request to the app.queries logger (see app/middleware.py), keeping this
+# many slowest statements per request
+SCAN_QUERY_LOGGING = False
+SCAN_QUERY_LOG_SLOWEST = 3
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'app.queries': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}